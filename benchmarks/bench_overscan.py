@@ -0,0 +1,52 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Timing of the overscan models on full size raw frames.'''
+
+from __future__ import print_function
+
+import timeit
+
+import numpy
+
+from megaradrp.core import overscan_trim_array
+
+
+def main(number=10):
+    data = numpy.random.normal(1000.0, 5.0, size=(4212, 4196))
+    data = data.astype('int16')
+    out = numpy.empty((4112, 4096), dtype='float32')
+
+    modes = [('scalar', 0), ('row', 0), ('row', 21)]
+    times = {}
+    for overscan, smooth in modes:
+        def func():
+            overscan_trim_array(data, out=out, overscan=overscan,
+                                smooth=smooth)
+        times[overscan, smooth] = min(timeit.repeat(func, number=number,
+                                                    repeat=3)) / number
+
+    base = times['scalar', 0]
+    for key in modes:
+        print('overscan=%-6s smooth=%-3d %8.2f ms  x%.2f' %
+              (key[0], key[1], times[key] * 1e3, times[key] / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Timing of the peak detection filters on a column cut.'''
+
+from __future__ import print_function
+
+import timeit
+
+import numpy
+from scipy.ndimage import generic_filter
+
+from megaradrp.trace.peakdetection import _vecS1, _vecS2
+
+
+def _generic_vecS1(k, data):
+    def func(x):
+        return x[k] - 0.5 * (x[:k].max() + x[k+1:].max())
+    return generic_filter(data, func, size=2*k+1)
+
+
+def _generic_vecS2(k, data):
+    def func(x):
+        return x[k] - 0.5 * (x[:k].mean() + x[k+1:].mean())
+    return generic_filter(data, func, size=2*k+1)
+
+
+def main(number=10, k=3):
+    # a 4112 pixel column cut, with fiber-like peaks
+    xx = numpy.arange(4112)
+    data = 100 + 1000 * numpy.cos(2 * numpy.pi * xx / 6.5) ** 2
+    data += numpy.random.normal(0, 10.0, size=xx.shape)
+
+    filters = [('max', _generic_vecS1, _vecS1),
+               ('mean', _generic_vecS2, _vecS2)]
+
+    for name, generic, vectorized in filters:
+        if not numpy.all(generic(k, data) == vectorized(k, data)):
+            raise ValueError('%s filter results differ' % name)
+        times = []
+        for func in [generic, vectorized]:
+            tt = min(timeit.repeat(lambda: func(k, data),
+                                   number=number, repeat=3))
+            times.append(tt / number)
+        print('%-4s generic_filter %8.3f ms  vectorized %8.3f ms  x%.0f' %
+              (name, times[0] * 1e3, times[1] * 1e3, times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
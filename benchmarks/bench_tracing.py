@@ -0,0 +1,72 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Timing of the tracing of fibers in a synthetic flat.'''
+
+from __future__ import print_function
+
+import timeit
+
+import numpy
+
+from megaradrp.trace.traces import init_traces, trace_global
+from megaradrp.trace._traces import tracing
+
+
+def create_flat(nfibers=100, shape=(800, 4096), sep=7.5):
+    rng = numpy.random.RandomState(1234)
+    rows, cols = shape
+    xx = numpy.arange(cols) - 0.5 * cols
+    yy = numpy.arange(rows)[:, numpy.newaxis]
+    image = rng.normal(0, 3, size=shape)
+    for i in range(nfibers):
+        center = 10 + sep * i + 1e-6 * xx ** 2 + 1e-3 * xx
+        image += 1000 * numpy.exp(-0.5 * ((yy - center) / 1.2) ** 2)
+    return image
+
+
+def main(number=5):
+    image = create_flat()
+    peaks = init_traces(image, center=2048, hs=1, background=10.0, npred=3)
+    starts = [trace.start for trace in peaks.values()]
+
+    def func():
+        for x, y, p in starts:
+            tracing(image, x=x, y=y, p=p, step=2, hs=1,
+                    background=10.0, maxdis=2.0)
+
+    tt = min(timeit.repeat(func, number=number, repeat=3)) / number
+    npoints = sum(len(tracing(image, x=x, y=y, p=p, step=2, hs=1,
+                              background=10.0, maxdis=2.0))
+                  for x, y, p in starts)
+    print('%d traces, %d points: %8.2f ms, %6.1f ns per point' %
+          (len(starts), npoints, tt * 1e3, tt / npoints * 1e9))
+
+    def func_global():
+        trace_global(image, starts, step=2, hs=1, background=10.0,
+                     maxdis=2.0)
+
+    tt = min(timeit.repeat(func_global, number=number, repeat=3)) / number
+    print('global tracing: %8.2f ms, %6.1f ns per point' %
+          (tt * 1e3, tt / npoints * 1e9))
+
+
+if __name__ == '__main__':
+    main()
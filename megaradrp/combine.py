@@ -0,0 +1,269 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Combination of stacks of frames'''
+
+import logging
+import tempfile
+
+import numpy
+
+from numina.array.combine import median as c_median
+from numina.array.combine import sigmaclip as c_sigmaclip
+
+from megaradrp.core import process_frames
+
+_logger = logging.getLogger('numina.recipes.megara')
+
+
+def combine_blocks(method, frames, flow, blocksize=64, dtype='float32',
+                   tmpdir=None, opener=None, nworkers=1, inflight=None,
+                   prefetch=1):
+    '''Combine a stack of frames in blocks of rows.
+
+    Each frame is opened, processed with `flow` and its data is
+    spilled to a temporary memory mapped stack, so that only one
+    processed frame (or `inflight` frames, with several workers)
+    is held in memory. The stack is then combined with
+    `method` in blocks of `blocksize` rows.
+
+    As the combination methods work pixel by pixel, the result is
+    identical to combining the whole stack at once.
+
+    :param method: a combination function, such as numina median
+    :param frames: a list of objects with an `open` method
+    :param flow: a flow applied to each opened frame
+    :param blocksize: number of rows combined at once
+    :param tmpdir: directory of the temporary stack
+    :param opener: a function returning the HDUList of a frame,
+        by default the `open` method of the frame is used
+    :param nworkers: number of threads opening and processing frames,
+        the frames are spilled in order as they are ready
+    :param inflight: maximum number of processed frames held at once,
+        see :func:`megaradrp.parallel.imap_ordered`
+    :param prefetch: number of frames opened ahead in a background
+        thread, see :func:`megaradrp.parallel.read_ahead`
+    :return: the combined array, with shape (3, rows, cols), and the
+        header of the first processed frame
+    '''
+
+    if blocksize < 1:
+        raise ValueError('blocksize must be positive')
+
+    if opener is None:
+        opener = lambda frame: frame.open()
+
+    nframes = len(frames)
+    stack = None
+    template_header = None
+
+    processed = process_frames(frames, flow, nworkers=nworkers,
+                               inflight=inflight, opener=opener,
+                               prefetch=prefetch)
+
+    with tempfile.TemporaryFile(dir=tmpdir) as fd:
+        for idx, hdulist in enumerate(processed):
+            try:
+                fdata = hdulist[0].data
+                if stack is None:
+                    template_header = hdulist[0].header
+                    shape = (nframes,) + fdata.shape
+                    _logger.debug('creating temporary stack %s', shape)
+                    stack = numpy.memmap(fd, dtype=dtype, mode='w+',
+                                         shape=shape)
+                stack[idx] = fdata
+            finally:
+                hdulist.close()
+
+        _logger.info('stacking %d images in blocks of %d rows',
+                     nframes, blocksize)
+
+        nrows = stack.shape[1]
+        result = numpy.empty((3,) + stack.shape[1:], dtype=dtype)
+        for start in range(0, nrows, blocksize):
+            region = slice(start, min(start + blocksize, nrows))
+            method([layer[region] for layer in stack], dtype=dtype,
+                   out=result[:, region])
+        del stack
+
+    return result, template_header
+
+
+class MeanCombiner(object):
+    '''Mean of frames, computed in a single pass.
+
+    The mean and the variance are updated with each frame
+    (with the weighted version of the Welford algorithm), so the
+    memory used does not depend on the number of frames. The variance
+    is the unbiased variance of the frames, with the weights taken as
+    reliability weights.
+
+    With `weights`, the weight of each frame is the value of the
+    header keyword `weights` (such as 'EXPTIME'), frames without it
+    or with a non positive value have weight 1. Otherwise all the
+    frames have the same weight.
+    '''
+
+    def __init__(self, weights=None):
+        self.weights = weights
+        self.nframes = 0
+        self.header = None
+        self._mean = None
+        self._m2 = None
+        self._wsum = 0.0
+        self._w2sum = 0.0
+
+    def frame_weight(self, header):
+        if self.weights is None:
+            return 1.0
+        weight = header.get(self.weights, 0.0)
+        if weight > 0:
+            return float(weight)
+        _logger.warning('invalid weight %r in frame, using 1', weight)
+        return 1.0
+
+    def add(self, hdulist):
+        '''Add the data of the first HDU of hdulist.'''
+        data = hdulist[0].data
+        weight = self.frame_weight(hdulist[0].header)
+        if self._mean is None:
+            self.header = hdulist[0].header
+            self._mean = numpy.zeros(data.shape, dtype='float64')
+            self._m2 = numpy.zeros(data.shape, dtype='float64')
+
+        self.nframes += 1
+        self._wsum += weight
+        self._w2sum += weight * weight
+
+        delta = data - self._mean
+        self._mean += delta * (weight / self._wsum)
+        # delta * (data - new mean), weighted
+        delta *= weight
+        delta *= data - self._mean
+        self._m2 += delta
+
+    def combine(self, dtype='float32'):
+        '''The mean, the variance and the number of frames.'''
+        if self.nframes == 0:
+            raise ValueError('no frames to combine')
+
+        out = numpy.empty((3,) + self._mean.shape, dtype=dtype)
+        out[0] = self._mean
+        norm = self._wsum - self._w2sum / self._wsum
+        if norm > 0:
+            out[1] = self._m2 / norm
+        else:
+            out[1] = 0.0
+        out[2] = self.nframes
+        return out
+
+
+class StackCombiner(object):
+    '''Combination of frames with a method using the full stack.
+
+    The frames are kept until they are combined with `method`, a
+    function with the signature of the numina combination methods,
+    such as numina median or sigmaclip. Only the data of the
+    frames is kept, converted to `dtype`, so that a stack of RSS
+    extracted in double precision takes half the memory.
+    '''
+
+    def __init__(self, method, dtype='float32', **kwargs):
+        self.method = method
+        self.dtype = dtype
+        self.kwargs = kwargs
+        self.nframes = 0
+        self.header = None
+        self._arrays = []
+
+    def add(self, hdulist):
+        '''Add the data of the first HDU of hdulist.'''
+        if self.header is None:
+            self.header = hdulist[0].header
+        self._arrays.append(numpy.asarray(hdulist[0].data,
+                                          dtype=self.dtype))
+        self.nframes += 1
+
+    def combine(self, dtype='float32'):
+        '''The combination, the variance and the number of points.'''
+        if self.nframes == 0:
+            raise ValueError('no frames to combine')
+        arrays, self._arrays = self._arrays, []
+        return self.method(arrays, dtype=dtype, **self.kwargs)
+
+
+COMBINE_METHODS = ('median', 'mean', 'wmean', 'sigmaclip')
+
+_STACK_METHODS = {'median': c_median, 'sigmaclip': c_sigmaclip}
+
+
+def create_combiner(method):
+    '''A combiner of frames for one of the COMBINE_METHODS.
+
+    'mean' and 'wmean' (mean weighted with the exposure time) are
+    computed in a single pass, with constant memory. 'median' and
+    'sigmaclip' keep all the frames.
+    '''
+
+    if method in _STACK_METHODS:
+        return StackCombiner(_STACK_METHODS[method])
+    elif method == 'mean':
+        return MeanCombiner()
+    elif method == 'wmean':
+        return MeanCombiner(weights='EXPTIME')
+    raise ValueError('unknown combination method %r' % method)
+
+
+def combine_frames(method, frames, flow, blocksize=0, dtype='float32',
+                   nworkers=1, prefetch=1, opener=None):
+    '''Process frames with flow and combine them with method.
+
+    method is one of the COMBINE_METHODS. With blocksize > 0, the
+    methods using the full stack ('median' and 'sigmaclip') spill the
+    processed frames to disk and combine them in blocks of rows (see
+    :func:`combine_blocks`), so that only a few frames are held in
+    memory. The mean methods always use constant memory.
+
+    :return: the combined array, with shape (3, rows, cols), and the
+        header of the first processed frame
+    '''
+
+    if blocksize < 0:
+        raise ValueError('blocksize must not be negative')
+
+    if blocksize > 0 and method in _STACK_METHODS:
+        return combine_blocks(_STACK_METHODS[method], frames, flow,
+                              blocksize=blocksize, dtype=dtype,
+                              opener=opener, nworkers=nworkers,
+                              prefetch=prefetch)
+
+    if opener is None:
+        opener = lambda frame: frame.open()
+
+    combiner = create_combiner(method)
+    for hdulist in process_frames(frames, flow, nworkers=nworkers,
+                                  prefetch=prefetch, opener=opener):
+        try:
+            combiner.add(hdulist)
+        finally:
+            hdulist.close()
+
+    _logger.info('stacking %d images using %s', combiner.nframes, method)
+
+    return combiner.combine(dtype=dtype), combiner.header
@@ -19,16 +19,23 @@
 
 from __future__ import print_function
 
+import os
+import threading
+from collections import namedtuple, OrderedDict
+
 from astropy.io import fits
 import numpy as np
+from scipy.ndimage import uniform_filter1d
 
 from numina.core import BaseRecipeAutoQC as MegaraBaseRecipe  # @UnusedImport
-from megaradrp.products import TraceMap
-from megarardrp.trace.peakdetection import peakdet
+from megaradrp.products import TraceMap, TraceTable
+from megaradrp.trace.peakdetection import peakdet
+from megaradrp.parallel import imap_ordered, read_ahead
 
 # row / column
 _binning = {'11': [1, 1], '21': [1, 2], '12': [2, 1], '22': [2, 2]}
 _direc = ['normal', 'mirror']
+OVERSCAN_MODES = ['scalar', 'row']
 
 
 def create(image, direction='normal', bins='11'):
@@ -116,11 +123,10 @@ def trim_and_o(image, out='trimmed.fits', direction='normal', bins='11'):
 def trim_and_o_hdu(hdu):
     '''Trim a MEGARA HDU with overscan.'''
 
-    # FIXME: this should come from the header
-    direction = 'normal'
-    bins = '11'
+    geom = header_geometry(hdu.header, hdu.data.shape)
 
-    finaldata = trim_and_o_array(hdu.data, direction=direction, bins=bins)
+    finaldata = trim_and_o_array(hdu.data, direction=geom.direction,
+                                 bins=geom.bins)
 
     hdu.data = finaldata
     return hdu
@@ -129,43 +135,332 @@ def trim_and_o_hdu(hdu):
 def trim_and_o_array(array, direction='normal', bins='11'):
     '''Trim a MEGARA array with overscan.'''
 
-    if direction not in _direc:
-        raise ValueError("%s must be either 'normal' or 'mirror'" % direction)
+    geom = raw_geometry(array.shape, bins=bins, direction=direction)
 
-    if direction == 'normal':
-        direcfun = lambda x: x
-    else:
-        direcfun = np.fliplr
+    finaldata = np.empty(geom.tshape, dtype='float32')
+    for amp in geom.amps:
+        region = array[amp.trim]
+        if geom.direction == 'mirror':
+            region = region[:, ::-1]
+        finaldata[amp.rows] = region
+    return finaldata
 
-    if bins not in _binning:
-        raise ValueError("%s must be one if '11', '12', '21, '22'" % bins)
 
-    OSCANW = 100
-    PSCANW = 50
-    H_X_DIM = 2048
-    H_Y_DIM = 2056
+# Regions of one amplifier in a raw image and the rows
+# it fills in the trimmed image
+_Amplifier = namedtuple('_Amplifier', ['rows', 'trim', 'pcol', 'ocol', 'orow'])
+
+# Geometry of a raw image: binning, direction, raw shape,
+# trimmed shape and amplifiers
+_Geometry = namedtuple('_Geometry', ['bins', 'direction', 'shape', 'tshape',
+                                     'amps'])
+
+# Header keywords with the binning along columns (axis 1)
+# and rows (axis 2) and the readout direction
+_BINKEYS = ('CCDBIN1', 'CCDBIN2')
+_DIRKEY = 'READDIR'
+
+_geometries = {}
+
+
+def _amplifier_regions(bins='11'):
+    '''Regions of the two amplifiers of a raw MEGARA image.'''
 
     bng = _binning[bins]
 
-    nr2 = H_Y_DIM * 2 / bng[0]
-    nc2 = H_X_DIM * 2 / bng[1]
+    nr = 2056 // bng[0]
+    nc = 2048 // bng[1]
+    nr2 = 2 * nr
+    nc2 = 2 * nc
+    oscan1 = 50 // bng[0]
+    oscan2 = oscan1 * 2
+    psc1 = 50 // bng[1]
+    psc2 = 2 * psc1
+    fshape = (nr2 + oscan2, nc2 + psc2)
+    # Row block 1
+    rb1 = slice(0, nr)
+    rb1m = slice(nr, nr + oscan1)
+    # Row block 2
+    rb2 = slice(nr + oscan2, nr2 + oscan2)
+    rb2m = slice(nr + oscan1, nr + oscan2)
+    # Col block
+    cb = slice(psc1, nc2 + psc1)
+    # Col block left
+    cbl = slice(0, psc1)
+    # Col block right
+    cbr = slice(nc2 + psc1, nc2 + psc2)
 
-    nr = H_Y_DIM / bng[0]
-    nc = H_X_DIM / bng[1]
+    amp1 = _Amplifier(slice(0, nr), (rb1, cb), (rb1, cbl), (rb1, cbr),
+                      (rb1m, cb))
+    amp2 = _Amplifier(slice(nr, nr2), (rb2, cb), (rb2, cbr), (rb2, cbl),
+                      (rb2m, cb))
+    return fshape, (nr2, nc2), (amp1, amp2)
 
-    oscan2 = OSCANW / bng[0]
-    psc1 = PSCANW / bng[0]
 
-    finaldata = np.empty((nr2, nc2), dtype='float32')
-    finaldata[:nr, :] = direcfun(array[:nr, psc1:nc2 + psc1])
-    finaldata[nr:, :] = direcfun(array[nr + oscan2:, psc1:nc2 + psc1])
-    return finaldata
+def raw_geometry(shape, bins='11', direction='normal'):
+    '''Geometry of a raw MEGARA image.
+
+    The regions are computed once per binning, direction and shape,
+    and cached for the rest of the process.
+    '''
+
+    key = (bins, direction, tuple(shape))
+    try:
+        return _geometries[key]
+    except KeyError:
+        pass
+
+    if direction not in _direc:
+        raise ValueError("%s must be either 'normal' or 'mirror'" % direction)
+
+    if bins not in _binning:
+        raise ValueError("%s must be one if '11', '12', '21, '22'" % bins)
+
+    fshape, tshape, amps = _amplifier_regions(bins)
+    if tuple(shape) != fshape:
+        raise ValueError('shape %s is not the raw shape %s of binning %s' %
+                         (tuple(shape), fshape, bins))
+
+    _logger.debug('computing geometry for binning %s, direction %s',
+                  bins, direction)
+    geom = _Geometry(bins, direction, fshape, tshape, amps)
+    _geometries[key] = geom
+    return geom
+
+
+def header_geometry(header, shape):
+    '''Geometry of a raw MEGARA image, from its header.
+
+    The binning and the readout direction are read from the header,
+    if they are missing the image is assumed unbinned and normal.
+    '''
+
+    bins = '%d%d' % tuple(header.get(key, 1) for key in _BINKEYS)
+    direction = header.get(_DIRKEY, 'normal')
+    return raw_geometry(shape, bins=bins, direction=direction)
+
+
+def overscan_trim_array(array, direction='normal', bins='11', out=None,
+                        bzero=0.0, bscale=1.0, overscan='scalar', smooth=0):
+    '''Correct a raw MEGARA array from overscan and trim it.
+
+    With `overscan` 'scalar', the level of each amplifier is the average
+    of the means of its prescan, row overscan and column overscan.
+    With `overscan` 'row', the level of each row is the mean of
+    its prescan and column overscan pixels, optionally smoothed along the
+    rows with a running mean of `smooth` rows.
+
+    The corrected trimmed image is written in `out`, a float32 array
+    that is created if not given.
+
+    `array` may contain unscaled raw values, as read with
+    `do_not_scale_image_data`; `bzero` and `bscale` are then
+    applied while filling `out`.
+    '''
+
+    if overscan not in OVERSCAN_MODES:
+        raise ValueError("%s must be either 'scalar' or 'row'" % overscan)
+
+    geom = raw_geometry(array.shape, bins=bins, direction=direction)
+
+    if out is None:
+        out = np.empty(geom.tshape, dtype='float32')
+    elif out.shape != geom.tshape:
+        raise ValueError('out shape %s is not the trimmed shape %s' %
+                         (out.shape, geom.tshape))
+
+    for amp in geom.amps:
+        if overscan == 'scalar':
+            # means are computed in double precision,
+            # over the unscaled values
+            means = [array[region].mean(dtype='float64')
+                     for region in [amp.pcol, amp.orow, amp.ocol]]
+            level = bzero + bscale * sum(means) / 3.0
+            _logger.debug('average scan is %f', level)
+        else:
+            level = _row_overscan(array, amp, smooth)
+            level = bzero + bscale * level[:, np.newaxis]
+            _logger.debug('average scan is %f', level.mean())
+
+        region = array[amp.trim]
+        if direction == 'mirror':
+            region = region[:, ::-1]
+
+        dest = out[amp.rows]
+        if bscale == 1:
+            np.subtract(region, level - bzero, out=dest, casting='unsafe')
+        else:
+            np.multiply(region, bscale, out=dest, casting='unsafe')
+            dest += bzero - level
+
+    return out
+
+
+def _row_overscan(array, amp, smooth=0):
+    '''Overscan level of each row of an amplifier.'''
+
+    pcol = array[amp.pcol]
+    ocol = array[amp.ocol]
+    level = pcol.sum(axis=1, dtype='float64')
+    level += ocol.sum(axis=1, dtype='float64')
+    level /= pcol.shape[1] + ocol.shape[1]
+    if smooth > 1:
+        level = uniform_filter1d(level, smooth, mode='nearest')
+    return level
+
+
+def read_raw(frame, out=None, overscan='scalar', smooth=0):
+    '''Read a raw MEGARA frame, corrected from overscan and trimmed.
+
+    The raw data is memory mapped and is not scaled, the corrected image
+    is written directly in `out`. The overscan is modelled according
+    to `overscan` and `smooth` (see :func:`overscan_trim_array`).
+    The header is marked as processed by :class:`OverscanTrimCorrector`
+    (and by :class:`OverscanCorrector` and :class:`TrimImage`),
+    so these nodes are skipped in a flow.
+
+    Frames not stored in a file or already processed are
+    opened as usual.
+    '''
+
+    if frame.filename is None or frame.frame is not None:
+        return frame.open()
+
+    with fits.open(frame.filename, memmap=True,
+                   do_not_scale_image_data=True) as hdulist:
+        hdu = hdulist[0]
+        header = hdu.header.copy()
+        if _overscan_tag.check_if_processed(header):
+            _logger.debug('frame %s is already processed', frame.filename)
+            return frame.open()
+
+        bzero = header.get('BZERO', 0.0)
+        bscale = header.get('BSCALE', 1.0)
+        geom = header_geometry(header, hdu.data.shape)
+        data = overscan_trim_array(hdu.data, direction=geom.direction,
+                                   bins=geom.bins, out=out, bzero=bzero,
+                                   bscale=bscale, overscan=overscan,
+                                   smooth=smooth)
+
+    for key in ['BZERO', 'BSCALE']:
+        if key in header:
+            del header[key]
+
+    _overscan_tag.tag_as_processed(header)
+    _trim_tag.tag_as_processed(header)
+
+    return fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+
+def process_frames(frames, flow, nworkers=1, inflight=None, opener=read_raw,
+                   prefetch=1):
+    '''Open and process frames with flow, in nworkers threads.
+
+    The processed HDULists are yielded in the order of frames, as
+    they are ready, with at most `inflight` frames held at once
+    (see :func:`megaradrp.parallel.imap_ordered`). The nodes of the
+    flow are shared by the workers, so they must not write in shared
+    buffers, such as the `out` buffer of :class:`OverscanTrimCorrector`.
+
+    With prefetch > 0, the frames are opened in a background thread,
+    up to `prefetch` frames ahead of the processing (see
+    :func:`megaradrp.parallel.read_ahead`). ValueError is raised at
+    once if nworkers is not positive or prefetch is negative.
+
+    :param opener: a function returning the HDUList of a frame
+    '''
+
+    if nworkers < 1:
+        raise ValueError('nworkers must be positive')
+    if prefetch < 0:
+        raise ValueError('prefetch must not be negative')
+
+    if prefetch > 0:
+        opened = read_ahead(opener, frames, depth=prefetch)
+        return imap_ordered(flow, opened, nworkers=nworkers,
+                            inflight=inflight)
+
+    def process(frame):
+        return flow(opener(frame))
+
+    return imap_ordered(process, frames, nworkers=nworkers,
+                        inflight=inflight)
+
+
+# Decoded calibrations, in bytes
+_CALIBRATION_CACHE_SIZE = 1024 ** 3
+_calibration_cache = OrderedDict()
+_calibration_lock = threading.Lock()
+
+
+def _decode_calibration(filename):
+    with fits.open(filename) as hdulist:
+        data = hdulist[0].data
+        data = np.array(data, dtype=data.dtype.newbyteorder('='))
+        header = hdulist[0].header.copy()
+    data.flags.writeable = False
+    return data, header
+
+
+def read_calibration(frame, cache=True):
+    '''Read the primary HDU of a calibration frame, such as a master bias.
+
+    The decoded data of the frames stored in files are kept in a
+    process-wide cache, keyed by the path of the file, so that the
+    recipes using the same calibrations read them once. A file modified
+    or replaced since it was cached (with a different modification or
+    status change time, inode or size) is read again. The least recently
+    used calibrations are removed when the cache grows over
+    _CALIBRATION_CACHE_SIZE bytes.
+
+    The data is a read-only view of the cached array, the header is
+    a copy. Frames not stored in a file are opened as usual.
+
+    :return: an HDUList with the primary HDU
+    '''
+
+    if frame.filename is None or frame.frame is not None:
+        return frame.open()
+
+    filename = os.path.abspath(frame.filename)
+    stat = os.stat(filename)
+    # FITS files are padded to blocks, the size seldom changes;
+    # the ctime changes with any write, even if the mtime is restored
+    stamp = (stat.st_mtime, stat.st_ctime, stat.st_ino, stat.st_size)
+
+    entry = None
+    if cache:
+        with _calibration_lock:
+            entry = _calibration_cache.pop(filename, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    _calibration_cache[filename] = entry
+                else:
+                    _logger.debug('calibration %s has changed', filename)
+                    entry = None
+
+    if entry is None:
+        _logger.debug('reading calibration %s', filename)
+        entry = (stamp,) + _decode_calibration(filename)
+        if cache and entry[1].nbytes <= _CALIBRATION_CACHE_SIZE:
+            with _calibration_lock:
+                _calibration_cache[filename] = entry
+                total = sum(e[1].nbytes for e in _calibration_cache.values())
+                while total > _CALIBRATION_CACHE_SIZE:
+                    _, old = _calibration_cache.popitem(last=False)
+                    total -= old[1].nbytes
+
+    _, data, header = entry
+    return fits.HDUList([fits.PrimaryHDU(data.view(), header=header.copy())])
 
 from numina.flow.processing import TagOptionalCorrector, TagFits
 import logging
 
 _logger = logging.getLogger('numina.recipes.megara')
 
+_overscan_tag = TagFits('NUM-OVPE', 'Over scan/prescan')
+_trim_tag = TagFits('NUM-TRIM', 'Trimming')
+
 
 class OverscanCorrector(TagOptionalCorrector):
 
@@ -174,42 +469,6 @@ class OverscanCorrector(TagOptionalCorrector):
     def __init__(self, datamodel=None, mark=True,
                  tagger=None, dtype='float32'):
 
-        # FIXME: these should come from the header
-        bng = [1, 1]
-        nr = 2056 / bng[0]
-        nc = 2048 / bng[1]
-        nr2 = 2 * nr
-        nc2 = 2 * nc
-        oscan1 = 50 / bng[0]
-        oscan2 = oscan1 * 2
-        psc1 = 50 / bng[0]
-        psc2 = 2 * psc1
-        fshape = (nr2 + oscan2, nc2 + psc2)
-        # Row block 1
-        rb1 = slice(0, nr)
-        rb1m = slice(nr, nr + oscan1)
-        # Row block 2
-        rb2 = slice(nr + oscan2, nr2 + oscan2)
-        rb2m = slice(nr + oscan1, nr + oscan2)
-        # Col block
-        cb = slice(psc1, nc2 + psc1)
-
-        # Col block left
-        cbl = slice(0, psc1)
-        # Col block right
-        cbr = slice(nc2 + psc1, nc2 + psc2)
-
-        # Mode normal
-        self.trim1 = (rb1, cb)
-        self.pcol1 = (rb1, cbl)
-        self.ocol1 = (rb1, cbr)
-        self.orow1 = (rb1m, cb)
-
-        self.trim2 = (rb2, cb)
-        self.pcol2 = (rb2, cbr)
-        self.ocol2 = (rb2, cbl)
-        self.orow2 = (rb2m, cb)
-
         if tagger is None:
             tagger = TagFits('NUM-OVPE', 'Over scan/prescan')
 
@@ -220,26 +479,27 @@ class OverscanCorrector(TagOptionalCorrector):
 
     def _run(self, img):
         data = img[0].data
+        amp1, amp2 = header_geometry(img[0].header, data.shape).amps
 
-        p1 = data[self.pcol1].mean()
+        p1 = data[amp1.pcol].mean()
         _logger.debug('prescan1 is %f', p1)
-        or1 = data[self.orow1].mean()
+        or1 = data[amp1.orow].mean()
         _logger.debug('row overscan1 is %f', or1)
-        oc1 = data[self.ocol1].mean()
+        oc1 = data[amp1.ocol].mean()
         _logger.debug('col overscan1 is %f', oc1)
         avg = (p1 + or1 + oc1) / 3.0
         _logger.debug('average scan1 is %f', avg)
-        data[self.trim1] -= avg
+        data[amp1.trim] -= avg
 
-        p2 = data[self.pcol2].mean()
+        p2 = data[amp2.pcol].mean()
         _logger.debug('prescan2 is %f', p2)
-        or2 = data[self.orow2].mean()
+        or2 = data[amp2.orow].mean()
         _logger.debug('row overscan2 is %f', or2)
-        oc2 = data[self.ocol2].mean()
+        oc2 = data[amp2.ocol].mean()
         _logger.debug('col overscan2 is %f', oc2)
         avg = (p2 + or2 + oc2) / 3.0
         _logger.debug('average scan2 is %f', avg)
-        data[self.trim2] -= avg
+        data[amp2.trim] -= avg
         return img
 
 
@@ -266,6 +526,53 @@ class TrimImage(TagOptionalCorrector):
         return img
 
 
+class OverscanTrimCorrector(TagOptionalCorrector):
+
+    '''A Node that corrects a frame from overscan and trims it.
+
+    It replaces :class:`OverscanCorrector` followed by
+    :class:`TrimImage`, computing the overscan level of each
+    amplifier and filling the trimmed image in one pass.
+
+    The overscan is modelled according to `overscan` and `smooth`,
+    see :func:`overscan_trim_array`.
+
+    If `out` is given, the trimmed image is written there. The buffer
+    is overwritten by each frame, so it can only be reused when the
+    result is copied before processing the next frame.
+    '''
+
+    def __init__(self, datamodel=None, mark=True,
+                 tagger=None, dtype='float32', out=None,
+                 overscan='scalar', smooth=0):
+
+        if tagger is None:
+            tagger = TagFits('NUM-OVPE', 'Over scan/prescan')
+
+        super(OverscanTrimCorrector, self).__init__(datamodel=datamodel,
+                                                    tagger=tagger,
+                                                    mark=mark,
+                                                    dtype=dtype)
+        self.mark = mark
+        self.out = out
+        self.overscan = overscan
+        self.smooth = smooth
+
+    def _run(self, img):
+        _logger.debug('correcting overscan and trimming image %s', img)
+
+        geom = header_geometry(img[0].header, img[0].data.shape)
+        img[0].data = overscan_trim_array(img[0].data,
+                                          direction=geom.direction,
+                                          bins=geom.bins, out=self.out,
+                                          overscan=self.overscan,
+                                          smooth=self.smooth)
+        if self.mark:
+            _trim_tag.tag_as_processed(img[0].header)
+
+        return img
+
+
 class ApertureExtractor(TagOptionalCorrector):
 
     '''A Node that extracts apertures.'''
@@ -296,12 +603,13 @@ class ApertureExtractor2(TagOptionalCorrector):
     '''A Node that extracts apertures.'''
 
     def __init__(self, trace, datamodel=None, mark=True,
-                 tagger=None, dtype='float32'):
+                 tagger=None, dtype='float32', nthreads=1):
 
         if tagger is None:
             tagger = TagFits('NUM-MAE', 'MEGARA Aperture extractor')
         
         self.trace = trace
+        self.nthreads = nthreads
 
         super(ApertureExtractor2, self).__init__(datamodel=datamodel,
                                                 tagger=tagger,
@@ -312,7 +620,7 @@ class ApertureExtractor2(TagOptionalCorrector):
     def _run(self, img):
         imgid = self.get_imgid(img)
         _logger.debug('extracting apertures2 in image %s', imgid)
-        rss = apextract2(img[0].data, self.trace)
+        rss = apextract2(img[0].data, self.trace, nthreads=self.nthreads)
         img[0].data = rss
         return img
 
@@ -391,39 +699,77 @@ def extract_region(data, border1, border2, pesos, xpos):
     return final
 
 
-def apextract2(data, tracemap):
-    '''Extract apertures using a tracemap.'''
-    
-    # FIXME: a little hackish
-    
-    pols = [np.poly1d(t['fitparms']) for t in tracemap]
-    
-    borders = []
-    pix_12 = 0.5 * (pols[1] + pols[0])
+def trace_coefficients(tracemap):
+    '''Polynomial coefficients of the traces, highest degree first.
+
+    The result has one row per trace. The coefficients of a
+    TraceTable are returned directly.
+    '''
+
+    return TraceTable.from_list(tracemap).coeffs
+
+
+def _aperture_borders(tracemap):
+    '''Coefficients of the lower and upper borders of the apertures.'''
+
+    coeffs = trace_coefficients(tracemap)
+    ncoef = coeffs.shape[1]
+
+    # borders half way between consecutive traces
+    mids = 0.5 * (coeffs[1:] + coeffs[:-1])
+
+    if len(coeffs) == 2:
+        # both traces are extracted, with the half distance outside
+        lower = np.array([1.5 * coeffs[0] - 0.5 * coeffs[1], mids[0]])
+        upper = np.array([mids[0], 2 * coeffs[1] - mids[0]])
+        return lower, upper
+
+    nborders = len(coeffs) - 1
+    lower = np.empty((nborders, ncoef))
+    upper = np.empty((nborders, ncoef))
     # Use the half distance in the first trace
-    pix_01 = 1.5 * pols[0] - 0.5 * pols[1]
-    pix_2 = pols[1]    
-    borders.append((pix_01, pix_12))
+    lower[0] = 1.5 * coeffs[0] - 0.5 * coeffs[1]
+    lower[1:] = mids[:nborders - 1]
+    upper[:-1] = mids[:nborders - 1]
+    # the upper border of the last extracted trace
+    upper[-1] = 2 * coeffs[-2] - mids[-2]
+    # FIXME: the last trace is not extracted
+    return lower, upper
+
+
+def apextract2(data, tracemap, nthreads=1):
+    '''Extract apertures using a tracemap.
+
+    The extraction is split among nthreads threads, the result
+    does not depend on the number of threads.
+    '''
+
+    from megaradrp.trace.extract import superex_batch
+
+    lower, upper = _aperture_borders(tracemap)
+
+    rss = np.zeros((len(tracemap), data.shape[1]))
+
+    superex_batch(data, lower, upper, out=rss, nthreads=nthreads)
+
+    return rss
+
 
-    for p2 in pols[2:-1]:
-     
-        pix_1, pix_01 = pix_2, pix_12 
-        pix_2 = p2
+def apextract_stack(stack, tracemap, nthreads=1):
+    '''Extract apertures of a stack of frames using a tracemap.
 
-        pix_12 = 0.5 * (pix_2 + pix_1)
-        borders.append((pix_01, pix_12))
+    stack has shape (frames, rows, columns) and can be memory mapped.
+    Returns the RSS of each frame, with shape (frames, apertures, columns),
+    the same as apextract2 applied to each frame.
+    '''
 
-    # extract the last trace
-    pix_1, pix_01 = pix_2, pix_12 
-    pix_12 = 2 * pix_1 - pix_01
-    borders.append((pix_01, pix_12))
+    from megaradrp.trace.extract import superex_stack
 
-    rss = np.empty((len(pols), data.shape[1]))
+    lower, upper = _aperture_borders(tracemap)
 
-    from megaradrp.trace.extract import superex
-    
-    superex(data, borders, out=rss)
+    rss = np.zeros((stack.shape[0], len(tracemap), stack.shape[2]))
 
+    superex_stack(stack, lower, upper, out=rss, nthreads=nthreads)
 
     return rss
 
@@ -0,0 +1,221 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Helpers to run work in parallel'''
+
+import collections
+import threading
+
+import numpy
+
+
+def run_blocks(func, size, nthreads):
+    '''Call func with contiguous blocks of range(size), in nthreads threads.
+
+    func receives a slice with its block. The blocks cover range(size)
+    in order, so the work done does not depend on the number of threads.
+    If func raises in any thread, the first exception is raised again
+    after all the threads have finished.
+    '''
+
+    nthreads = min(nthreads, size)
+    if nthreads <= 1:
+        func(slice(0, size))
+        return
+
+    limits = numpy.linspace(0, size, nthreads + 1).astype('int')
+    errors = []
+
+    def worker(region):
+        try:
+            func(region)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(slice(l1, l2),))
+               for l1, l2 in zip(limits[:-1], limits[1:])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+class _Task(object):
+    '''An item to process and, when done, its result or its error.'''
+
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def imap_ordered(func, items, nworkers=1, inflight=None):
+    '''Apply func to each of items, in a pool of nworkers threads.
+
+    The results are yielded in the order of items, each one as soon
+    as it and the previous ones are ready. At most `inflight` items
+    (by default, twice the number of workers) are taken from items
+    and not yet yielded, so the memory used is bounded even if the
+    consumer is slower than the workers. If func raises, the
+    exception is raised again when its result is reached.
+
+    func must be safe to call from several threads. With nworkers
+    equal to 1, func is called in the calling thread.
+    '''
+
+    if nworkers < 1:
+        raise ValueError('nworkers must be positive')
+
+    if inflight is None:
+        inflight = 2 * nworkers
+    elif inflight < 1:
+        raise ValueError('inflight must be positive')
+
+    if nworkers == 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pending = collections.deque()
+    ready = threading.Condition()
+    queued = collections.deque()
+    state = {'closed': False}
+
+    def worker():
+        while True:
+            with ready:
+                while not queued and not state['closed']:
+                    ready.wait()
+                if not queued:
+                    return
+                task = queued.popleft()
+            try:
+                task.result = func(task.item)
+            except Exception as error:
+                task.error = error
+            task.done.set()
+
+    threads = [threading.Thread(target=worker) for _ in range(nworkers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def submit(item):
+        task = _Task(item)
+        pending.append(task)
+        with ready:
+            queued.append(task)
+            ready.notify()
+
+    try:
+        items = iter(items)
+        for item in items:
+            submit(item)
+            if len(pending) >= inflight:
+                break
+
+        while pending:
+            task = pending.popleft()
+            task.done.wait()
+            if task.error is not None:
+                raise task.error
+            result = task.result
+            task.result = None
+            yield result
+            del result
+            # the consumer is done with the result, take another item
+            for item in items:
+                submit(item)
+                break
+    finally:
+        with ready:
+            queued.clear()
+            state['closed'] = True
+            ready.notify_all()
+        for thread in threads:
+            thread.join()
+
+
+def read_ahead(func, items, depth=1):
+    '''Apply func to each of items in a background thread.
+
+    The results are yielded in the order of items. The thread works
+    ahead of the consumer, keeping up to `depth` results ready, so
+    that reading the next items overlaps with the processing of the
+    current one. If func raises, no more items are read and the
+    exception is raised again when its result is reached.
+    '''
+
+    if depth < 1:
+        raise ValueError('depth must be positive')
+
+    buffered = collections.deque()
+    ready = threading.Condition()
+    state = {'closed': False, 'done': False}
+
+    def reader():
+        try:
+            for item in items:
+                with ready:
+                    while len(buffered) >= depth and not state['closed']:
+                        ready.wait()
+                    if state['closed']:
+                        return
+                value = func(item)
+                with ready:
+                    buffered.append((value, None))
+                    ready.notify_all()
+                del value
+        except Exception as error:
+            with ready:
+                buffered.append((None, error))
+        finally:
+            with ready:
+                state['done'] = True
+                ready.notify_all()
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            with ready:
+                while not buffered and not state['done']:
+                    ready.wait()
+                if not buffered:
+                    return
+                value, error = buffered.popleft()
+                ready.notify_all()
+            if error is not None:
+                raise error
+            yield value
+            del value
+    finally:
+        with ready:
+            state['closed'] = True
+            ready.notify_all()
+        thread.join()
@@ -38,6 +38,8 @@
 '''
 
 
+import numpy
+
 from numina.core import DataFrameType, DataProductType
 
 
@@ -61,5 +63,100 @@ class TraceMap(DataProductType):
 
     def __init__(self, default=None):
         super(TraceMap, self).__init__(
-            ptype=dict, default=default)
-
+            ptype=TraceTable, default=default)
+
+
+class TraceTable(object):
+    '''Traces of the fibers, stored in arrays.
+
+    Each trace has a fiber id, a box id, the first and last columns
+    where it is valid and the coefficients of its polynomial, highest
+    degree first. The coefficients of all the traces are the rows of
+    coeffs.
+
+    Iterating over the table gives a dictionary for each trace, with
+    the keys of the older trace maps (fibid, boxid, start, stop and
+    fitparms). Indexing with an integer gives one of these dictionaries,
+    with a slice or an index array gives another table.
+    '''
+
+    __slots__ = ('fibid', 'boxid', 'start', 'stop', 'coeffs')
+
+    def __init__(self, fibid, boxid, start, stop, coeffs):
+        fibid = numpy.asarray(fibid, dtype='int')
+        size = len(fibid)
+        self.fibid = fibid
+        self.boxid = numpy.asarray(boxid, dtype='int')
+        self.start = numpy.broadcast_arrays(
+            numpy.asarray(start, dtype='int'), fibid)[0].copy()
+        self.stop = numpy.broadcast_arrays(
+            numpy.asarray(stop, dtype='int'), fibid)[0].copy()
+        coeffs = numpy.asarray(coeffs, dtype='float64')
+        if coeffs.ndim == 2:
+            ncoef = coeffs.shape[1]
+        else:
+            # an empty table has no coefficients to infer the degree
+            ncoef = -1 if size else 1
+        self.coeffs = coeffs.reshape((size, ncoef))
+
+        if len(self.boxid) != size:
+            raise ValueError('boxid and fibid must have the same size')
+
+    @classmethod
+    def from_list(cls, traces):
+        '''Table from a list of trace dictionaries.
+
+        The polynomials can have different degrees, the shorter
+        ones are padded with zeros.
+        '''
+        if isinstance(traces, cls):
+            return traces
+
+        fitparms = [numpy.trim_zeros(numpy.atleast_1d(t['fitparms']), 'f')
+                    for t in traces]
+        ncoef = max([len(c) for c in fitparms] + [1])
+        coeffs = numpy.zeros((len(fitparms), ncoef))
+        for row, c in zip(coeffs, fitparms):
+            row[ncoef - len(c):] = c
+
+        return cls([t['fibid'] for t in traces], [t['boxid'] for t in traces],
+                   [t['start'] for t in traces], [t['stop'] for t in traces],
+                   coeffs)
+
+    def to_list(self):
+        '''The traces, as a list of dictionaries.'''
+        return [self._trace(idx) for idx in range(len(self))]
+
+    def _trace(self, idx):
+        return {'fibid': int(self.fibid[idx]), 'boxid': int(self.boxid[idx]),
+                'start': int(self.start[idx]), 'stop': int(self.stop[idx]),
+                'fitparms': self.coeffs[idx].tolist()}
+
+    def __len__(self):
+        return len(self.fibid)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self._trace(idx)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, numpy.integer)):
+            return self._trace(key)
+        return TraceTable(self.fibid[key], self.boxid[key], self.start[key],
+                          self.stop[key], self.coeffs[key])
+
+    def __repr__(self):
+        return '<TraceTable with %d traces>' % len(self)
+
+    def box(self, boxid):
+        '''The traces of the box boxid.'''
+        return self[self.boxid == boxid]
+
+    def evaluate(self, x):
+        '''Position of all the traces in the columns x.
+
+        :return: an array with shape (traces, len(x))
+        '''
+        from megaradrp.trace.extract import polyval_rows
+
+        return polyval_rows(self.coeffs, numpy.atleast_1d(x))
@@ -19,6 +19,7 @@
 
 '''Calibration Recipes for Megara'''
 
+import functools
 import logging
 
 import numpy
@@ -33,17 +34,23 @@ from numina.core import Product, DataProductRequirement, Requirement
 from numina.core.products import ArrayType
 from numina.core.requirements import ObservationResultRequirement
 from numina.core import RecipeError
-from numina.array.combine import median as c_median
 from numina.flow import SerialFlow
 from numina.flow.processing import BiasCorrector
 
 from megaradrp.core import MegaraBaseRecipe
-from megaradrp.core import OverscanCorrector, TrimImage
+from megaradrp.core import OverscanTrimCorrector
+from megaradrp.core import read_raw, read_calibration
 from megaradrp.core import ApertureExtractor, FiberFlatCorrector
 from megaradrp.core import peakdet
+from megaradrp.combine import combine_frames
 # from numina.logger import log_to_history
 from megaradrp.requirements import MasterBiasRequirement
 from megaradrp.requirements import MasterFiberFlatRequirement
+from megaradrp.requirements import check_parameters
+from megaradrp.requirements import CombinationMethodParameter
+from megaradrp.requirements import BlocksizeParameter, NWorkersParameter
+from megaradrp.requirements import PrefetchParameter, OverscanParameter
+from megaradrp.requirements import SmoothParameter
 from megaradrp.products import MasterBias, MasterDark, MasterFiberFlat
 from megaradrp.products import TraceMap, MasterSensitivity
 
@@ -55,6 +62,12 @@ class BiasRecipe(MegaraBaseRecipe):
     '''Process BIAS images and create MASTER_BIAS.'''
 
     obresult = ObservationResultRequirement()
+    blocksize = BlocksizeParameter()
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
+    method = CombinationMethodParameter()
 
     biasframe = Product(MasterBias)
 
@@ -65,35 +78,35 @@ class BiasRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
-        return self.process(rinput.obresult)
+        check_parameters(rinput)
 
-    def process(self, obresult):
+        return self.process(rinput.obresult, blocksize=rinput.blocksize,
+                            nworkers=rinput.nworkers,
+                            prefetch=rinput.prefetch,
+                            method=rinput.method,
+                            overscan=rinput.overscan,
+                            smooth=rinput.smooth)
+
+    def process(self, obresult, blocksize=0, nworkers=1, prefetch=1,
+                method='median', overscan='scalar', smooth=0):
         _logger.info('starting bias reduction')
 
         if not obresult.frames:
             raise RecipeError('Frame list is empty')
 
-        cdata = []
-
-        o_c = OverscanCorrector()
-        t_i = TrimImage()
+        o_t = OverscanTrimCorrector(overscan=overscan, smooth=smooth)
 
-        basicflow = SerialFlow([o_c, t_i])
+        basicflow = SerialFlow([o_t])
+        opener = functools.partial(read_raw, overscan=overscan, smooth=smooth)
 
-        try:
-            for frame in obresult.frames:
-                hdulist = frame.open()
-                hdulist = basicflow(hdulist)
-                cdata.append(hdulist)
+        data, template_header = combine_frames(method, obresult.frames,
+                                               basicflow,
+                                               blocksize=blocksize,
+                                               nworkers=nworkers,
+                                               prefetch=prefetch,
+                                               opener=opener)
 
-            _logger.info('stacking %d images using median', len(cdata))
-
-            data = c_median([d[0].data for d in cdata], dtype='float32')
-            template_header = cdata[0][0].header
-            hdu = fits.PrimaryHDU(data[0], header=template_header)
-        finally:
-            for hdulist in cdata:
-                hdulist.close()
+        hdu = fits.PrimaryHDU(data[0], header=template_header)
 
         hdr = hdu.header
         hdr = self.set_base_headers(hdr)
@@ -144,6 +157,11 @@ class PseudoFluxCalibrationRecipe(MegaraBaseRecipe):
     traces = Requirement(TraceMap, 'Trace information of the Apertures')
     reference_spectrum = DataProductRequirement(
         MasterFiberFlat, 'Reference spectrum')
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
+    method = CombinationMethodParameter()
 
     calibration = Product(MasterSensitivity)
     calibration_rss = Product(MasterSensitivity)
@@ -155,36 +173,33 @@ class PseudoFluxCalibrationRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
+        check_parameters(rinput)
+
         _logger.info('starting pseudo flux calibration')
 
-        o_c = OverscanCorrector()
-        t_i = TrimImage()
+        o_t = OverscanTrimCorrector(overscan=rinput.overscan,
+                                    smooth=rinput.smooth)
 
-        with rinput.master_bias.open() as hdul:
-            mbias = hdul[0].data.copy()
+        with read_calibration(rinput.master_bias) as hdul:
+            mbias = hdul[0].data
             b_c = BiasCorrector(mbias)
 
         a_e = ApertureExtractor(rinput.traces)
 
-        with rinput.master_fiber_flat.open() as hdul:
+        with read_calibration(rinput.master_fiber_flat) as hdul:
             f_f_c = FiberFlatCorrector(hdul)
 
-        basicflow = SerialFlow([o_c, t_i, b_c, a_e, f_f_c])
-
-        t_data = []
-
-        try:
-            for frame in rinput.obresult.frames:
-                hdulist = frame.open()
-                hdulist = basicflow(hdulist)
-                t_data.append(hdulist)
-
-            data_t = c_median([d[0].data for d in t_data], dtype='float32')
-            template_header = t_data[0][0].header
-            hdu_t = fits.PrimaryHDU(data_t[0], header=template_header)
-        finally:
-            for hdulist in t_data:
-                hdulist.close()
+        basicflow = SerialFlow([o_t, b_c, a_e, f_f_c])
+        opener = functools.partial(read_raw, overscan=rinput.overscan,
+                                   smooth=rinput.smooth)
+
+        data_t, template_header = combine_frames(rinput.method,
+                                                 rinput.obresult.frames,
+                                                 basicflow,
+                                                 nworkers=rinput.nworkers,
+                                                 prefetch=rinput.prefetch,
+                                                 opener=opener)
+        hdu_t = fits.PrimaryHDU(data_t[0], header=template_header)
 
         hdr = hdu_t.header
         hdr = self.set_base_headers(hdr)
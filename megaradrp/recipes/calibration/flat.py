@@ -21,61 +21,64 @@
 
 from __future__ import division, print_function
 
+import functools
 import logging
 
-import numpy
+import numpy as np
 from astropy.io import fits
 
-from numina.core import Product
+from numina.core import Product, Parameter, RecipeError
 from numina.core.products import ArrayType
 from numina.core.requirements import ObservationResultRequirement
-from numina.array.combine import median as c_median
+from numina.core.requirements import Requirement
 from numina.flow import SerialFlow
 from numina.flow.processing import BiasCorrector
 
 from megaradrp.core import MegaraBaseRecipe
-from megaradrp.core import OverscanCorrector, TrimImage
+from megaradrp.core import OverscanTrimCorrector
+from megaradrp.core import read_raw, read_calibration
 # from numina.logger import log_to_history
 
 from megaradrp.products import MasterFiberFlat
-from megaradrp.products import TraceMap
+from megaradrp.products import TraceMap, TraceTable
 from megaradrp.requirements import MasterBiasRequirement
+from megaradrp.requirements import check_parameters
+from megaradrp.requirements import CombinationMethodParameter
+from megaradrp.requirements import BlocksizeParameter, NWorkersParameter
+from megaradrp.requirements import PrefetchParameter, OverscanParameter
+from megaradrp.requirements import SmoothParameter
 
 from megaradrp.trace.traces import init_traces
-from megaradrp.trace._traces import tracing  # @UnresolvedImport
+from megaradrp.trace.traces import trace_all, trace_global, polyfit_batch
+from megaradrp.trace.traces import measure_offsets, trace_residuals
+from megaradrp.trace.traces import column_profiles
+from megaradrp.trace.extract import polyval_rows
 from megaradrp.core import apextract2
+from megaradrp.combine import combine_frames
 
 _logger = logging.getLogger('numina.recipes.megara')
 
 
-def process_common(recipe, obresult, master_bias):
+def process_common(recipe, obresult, master_bias, nworkers=1,
+                   prefetch=1, method='median', blocksize=0,
+                   overscan='scalar', smooth=0):
     _logger.info('starting prereduction')
 
-    o_c = OverscanCorrector()
-    t_i = TrimImage()
+    o_t = OverscanTrimCorrector(overscan=overscan, smooth=smooth)
 
-    with master_bias.open() as hdul:
-        mbias = hdul[0].data.copy()
+    with read_calibration(master_bias) as hdul:
+        mbias = hdul[0].data
         b_c = BiasCorrector(mbias)
 
-    basicflow = SerialFlow([o_c, t_i, b_c])
+    basicflow = SerialFlow([o_t, b_c])
+    opener = functools.partial(read_raw, overscan=overscan, smooth=smooth)
 
-    cdata = []
-
-    try:
-        for frame in obresult.frames:
-            hdulist = frame.open()
-            hdulist = basicflow(hdulist)
-            cdata.append(hdulist)
-
-        _logger.info('stacking %d images using median', len(cdata))
-
-        data = c_median([d[0].data for d in cdata], dtype='float32')
-        template_header = cdata[0][0].header
-        hdu = fits.PrimaryHDU(data[0], header=template_header)
-    finally:
-        for hdulist in cdata:
-            hdulist.close()
+    data, template_header = combine_frames(method, obresult.frames,
+                                           basicflow, blocksize=blocksize,
+                                           nworkers=nworkers,
+                                           prefetch=prefetch,
+                                           opener=opener)
+    hdu = fits.PrimaryHDU(data[0], header=template_header)
 
     hdr = hdu.header
     hdr['IMGTYP'] = ('FIBER_FLAT', 'Image type')
@@ -98,6 +101,18 @@ class FiberFlatRecipe(MegaraBaseRecipe):
     # Requirements
     master_bias = MasterBiasRequirement()
     obresult = ObservationResultRequirement()
+    nthreads = Parameter(1, 'Number of threads used in the tracing')
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
+    method = CombinationMethodParameter()
+    blocksize = BlocksizeParameter()
+    reference_traces = Requirement(TraceMap, 'Reference trace map, the '
+                                   'traces are updated instead of traced',
+                                   optional=True)
+    update_mode = Parameter('global', "Offsets of the updated traces, "
+                            "'global' or 'box'")
     # Products
     fiberflat_frame = Product(MasterFiberFlat)
     fiberflat_rss = Product(MasterFiberFlat)
@@ -110,20 +125,46 @@ class FiberFlatRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
-        return self.process_base1(rinput.obresult, rinput.master_bias)
+        check_parameters(rinput)
+
+        if rinput.update_mode not in ('global', 'box'):
+            raise RecipeError('invalid update mode %r' % rinput.update_mode)
+
+        return self.process_base1(rinput.obresult, rinput.master_bias,
+                                  nthreads=rinput.nthreads,
+                                  nworkers=rinput.nworkers,
+                                  prefetch=rinput.prefetch,
+                                  method=rinput.method,
+                                  blocksize=rinput.blocksize,
+                                  overscan=rinput.overscan,
+                                  smooth=rinput.smooth,
+                                  reference=rinput.reference_traces,
+                                  update_mode=rinput.update_mode)
 
     
-    def process_base1(self, obresult, master_bias):
+    def process_base1(self, obresult, master_bias, nthreads=1, nworkers=1,
+                      prefetch=1, method='median', blocksize=0,
+                      overscan='scalar', smooth=0, reference=None,
+                      update_mode='global'):
         _logger.info('starting fiber flat reduction')
 
-        reduced = process_common(self, obresult, master_bias)
+        reduced = process_common(self, obresult, master_bias,
+                                 nworkers=nworkers, prefetch=prefetch,
+                                 method=method, blocksize=blocksize,
+                                 overscan=overscan, smooth=smooth)
         
         cstart = 2000
         step = 2
     
-        tracemap = self.trace(reduced[0].data, cstart, step)
+        if reference is not None:
+            tracemap = self.update_trace(reduced[0].data, reference, cstart,
+                                         step, mode=update_mode,
+                                         nthreads=nthreads)
+        else:
+            tracemap = self.trace(reduced[0].data, cstart, step,
+                                  nthreads=nthreads)
         
-        rss = apextract2(reduced[0].data, tracemap)
+        rss = apextract2(reduced[0].data, tracemap, nthreads=nthreads)
         
         rss[rss <= 0] = 1
         
@@ -137,7 +178,7 @@ class FiberFlatRecipe(MegaraBaseRecipe):
 
         return result
 
-    def trace(self, data, cstart, step):
+    def trace(self, data, cstart, step, nthreads=1):
 
 
         # fit_traces = domefun(data, cstart=2000, hs=20)
@@ -157,36 +198,81 @@ class FiberFlatRecipe(MegaraBaseRecipe):
         
         _logger.info(' %i peaks found', len(central_peaks))
 
-        tracelist = []
-        if data.dtype.byteorder != '=':
-            _logger.debug('byteswapping image')
-            image2 = data.byteswap().newbyteorder()
-        else:
-            image2 = data
-            
         _logger.info('trace peaks')
-        for trace in central_peaks.values():
-            x, y, p = trace.start
+        peaks = list(central_peaks.values())
+        points, offsets = trace_all(data, [trace.start for trace in peaks],
+                                    step=step1, hs=hs,
+                                    background=background1, maxdis=maxdis1,
+                                    nthreads=nthreads)
 
-            mm = tracing(image2, x=x, y=y,
-                         p=p, step=step1, hs=hs,
-                         background=background1, maxdis=maxdis1
-                         )
+        pfits = polyfit_batch(points[:,0], points[:,1], offsets, deg=5)
 
-            pfit = numpy.polyfit(mm[:,0], mm[:,1], deg=5)
-            
-            tracelist.append({'fibid': trace.fibid, 'boxid': trace.boxid,
-                              'start':0, 'stop':4095,
-                              'fitparms': pfit.tolist()})
+        return TraceTable([trace.fibid for trace in peaks],
+                          [trace.boxid for trace in peaks],
+                          start=0, stop=4095, coeffs=pfits)
 
-            #plt.title('cython version, fiber %i' % trace.fibid)
-            #plt.plot(mm[:,0], mm[:,1], 'r*')
-            #xpix = np.arange(0, 2000, 1)
-            #p = numpy.poly1d(pfit)
-            #plt.plot(xpix, p(xpix), 'b')
-            #plt.show()    
+    def update_trace(self, data, reference, cstart, step, mode='global',
+                     nthreads=1):
+        '''Update a reference trace map.
 
-        return tracelist
+        The offset and tilt of the traces are measured with respect to
+        the reference, for all the traces or for each box. The traces
+        that do not follow the peaks after the correction are traced
+        again, starting in cstart.
+        '''
+
+        hs = 1
+        step1 = step
+        background1 = 10.0
+        maxdis1 = 2.0
+        # residuals, in pixels
+        maxres = 0.3
+        ncolumns = 9
+
+        reference = TraceTable.from_list(reference)
+        coeffs = reference.coeffs.copy()
+        deg = coeffs.shape[1] - 1
+        columns = np.linspace(100, data.shape[1] - 100, ncolumns)
+        columns = columns.astype('int')
+
+        if mode == 'box':
+            groups = reference.boxid
+        else:
+            groups = np.zeros((len(reference),), dtype='int')
+
+        _logger.info('measure offsets of %i traces in %i columns',
+                     len(reference), ncolumns)
+        labels, offsets, tilts = measure_offsets(data, coeffs, columns,
+                                                 groups=groups)
+        for label, offset, tilt in zip(labels, offsets, tilts):
+            _logger.debug('group %s, offset %f, tilt %g', label, offset, tilt)
+
+        idx = np.searchsorted(labels, groups)
+        coeffs[:, -1] += offsets[idx]
+        coeffs[:, -2] += tilts[idx]
+
+        residuals = trace_residuals(data, coeffs, columns, hs=hs)
+        bad = ~np.all(np.abs(residuals) <= maxres, axis=1)
+        _logger.info('%i traces do not follow the reference, trace them',
+                     bad.sum())
+
+        if bad.any():
+            ypos = polyval_rows(coeffs[bad], [cstart])[:, 0]
+            pix = np.floor(ypos + 0.5).astype('int').clip(0, data.shape[0] - 1)
+            profile = column_profiles(data, [cstart], hs)[:, 0]
+            starts = [(cstart, y, profile[p]) for y, p in zip(ypos, pix)]
+
+            points, toffsets = trace_all(data, starts, step=step1, hs=hs,
+                                         background=background1,
+                                         maxdis=maxdis1, nthreads=nthreads)
+            pfits = polyfit_batch(points[:,0], points[:,1], toffsets, deg=deg)
+            # keep the shifted reference if there are too few points
+            traced = np.diff(toffsets) > 10 * (deg + 1)
+            update = np.flatnonzero(bad)[traced]
+            coeffs[update] = pfits[traced]
+
+        return TraceTable(reference.fibid, reference.boxid, reference.start,
+                          reference.stop, coeffs)
 
 
 class TwilightFiberFlatRecipe(MegaraBaseRecipe):
@@ -212,6 +298,16 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
     obresult = ObservationResultRequirement()
     master_bias = MasterBiasRequirement()
+    nthreads = Parameter(1, 'Number of threads used in the tracing')
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
+    method = CombinationMethodParameter()
+    blocksize = BlocksizeParameter()
+    tracing = Parameter('fiber', "Tracing mode, 'fiber' traces each fiber "
+                        "independently, 'global' traces all of them "
+                        "together")
     fiberflat_frame = Product(MasterFiberFlat)
     traces = Product(TraceMap)
 
@@ -222,8 +318,18 @@ class TraceMapRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
+        check_parameters(rinput)
+
+        if rinput.tracing not in ('fiber', 'global'):
+            raise RecipeError('invalid tracing mode %r' % rinput.tracing)
 
-        result = self.process_base(rinput.obresult, rinput.master_bias)
+        result = self.process_base(rinput.obresult, rinput.master_bias,
+                                   nworkers=rinput.nworkers,
+                                   prefetch=rinput.prefetch,
+                                   method=rinput.method,
+                                   blocksize=rinput.blocksize,
+                                   overscan=rinput.overscan,
+                                   smooth=rinput.smooth)
 
         data = result[0].data
 
@@ -243,35 +349,33 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
         _logger.info(' %i peaks found', len(central_peaks))
 
-        tracelist = []
-        if data.dtype.byteorder != '=':
-            _logger.debug('byteswapping image')
-            image2 = data.byteswap().newbyteorder()
+        _logger.info('trace peaks, %s mode', rinput.tracing)
+        peaks = list(central_peaks.values())
+        starts = [trace.start for trace in peaks]
+        if rinput.tracing == 'global':
+            points, offsets = trace_global(data, starts, step=step1, hs=hs,
+                                           background=background1,
+                                           maxdis=maxdis1)
         else:
-            image2 = data
-            
-        _logger.info('trace peaks')
-        for trace in central_peaks.values():
-
-            mm = tracing(image2, x=cstart, y=trace.trace_f[0], step=step1,
-                         hs=hs, background=background1, maxdis=maxdis1)
+            points, offsets = trace_all(data, starts, step=step1, hs=hs,
+                                        background=background1,
+                                        maxdis=maxdis1,
+                                        nthreads=rinput.nthreads)
 
-            pfit = numpy.polyfit(mm[:,0], mm[:,1], deg=5)
-            
-            tracelist.append({'fibid': trace.fibid, 'boxid': trace.boxid,
-                              'start':0, 'stop':4095,
-                              'fitparms': pfit.tolist()})
+        pfits = polyfit_batch(points[:,0], points[:,1], offsets, deg=5)
 
-            #plt.title('cython version, fiber %i' % trace.fibid)
-            #plt.plot(mm[:,0], mm[:,1], 'r*')
-            #xpix = np.arange(0, 2000, 1)
-            #p = numpy.poly1d(pfit)
-            #plt.plot(xpix, p(xpix), 'b')
-            #plt.show()    
+        tracemap = TraceTable([trace.fibid for trace in peaks],
+                              [trace.boxid for trace in peaks],
+                              start=0, stop=4095, coeffs=pfits)
 
         return self.create_result(fiberflat_frame=result,
-                                  traces=tracelist)
-
-    def process_base(self, obresult, master_bias):
-        reduced = process_common(self, obresult, master_bias)
+                                  traces=tracemap)
+
+    def process_base(self, obresult, master_bias, nworkers=1, prefetch=1,
+                     method='median', blocksize=0, overscan='scalar',
+                     smooth=0):
+        reduced = process_common(self, obresult, master_bias,
+                                 nworkers=nworkers, prefetch=prefetch,
+                                 method=method, blocksize=blocksize,
+                                 overscan=overscan, smooth=smooth)
         return reduced
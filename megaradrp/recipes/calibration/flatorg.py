@@ -19,6 +19,7 @@
 
 '''Original fiber flat calibration recipes'''
 
+import functools
 import logging
 
 import numpy
@@ -32,10 +33,14 @@ from numina.flow import SerialFlow
 from numina.flow.processing import BiasCorrector
 
 from megaradrp.core import MegaraBaseRecipe
-from megaradrp.core import OverscanCorrector, TrimImage
+from megaradrp.core import OverscanTrimCorrector
+from megaradrp.core import process_frames, read_raw
 from megaradrp.core import peakdet
 from megaradrp.products import MasterFiberFlat
 from megaradrp.requirements import MasterBiasRequirement
+from megaradrp.requirements import check_parameters
+from megaradrp.requirements import NWorkersParameter, PrefetchParameter
+from megaradrp.requirements import OverscanParameter, SmoothParameter
 
 _logger = logging.getLogger('numina.recipes.megara')
 
@@ -46,6 +51,10 @@ class FiberFlatRecipe(MegaraBaseRecipe):
 
     master_bias = MasterBiasRequirement()
     obresult = ObservationResultRequirement()
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
 
     fiberflat_frame = Product(MasterFiberFlat)
     fiberflat_rss = Product(MasterFiberFlat)
@@ -58,23 +67,28 @@ class FiberFlatRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
+        check_parameters(rinput)
+
         _logger.info('starting fiber flat reduction')
 
-        o_c = OverscanCorrector()
-        t_i = TrimImage()
+        o_t = OverscanTrimCorrector(overscan=rinput.overscan,
+                                    smooth=rinput.smooth)
 
         with rinput.master_bias.open() as hdul:
             mbias = hdul[0].data.copy()
             b_c = BiasCorrector(mbias)
 
-        basicflow = SerialFlow([o_c, t_i, b_c])
+        basicflow = SerialFlow([o_t, b_c])
+        opener = functools.partial(read_raw, overscan=rinput.overscan,
+                                   smooth=rinput.smooth)
 
         cdata = []
 
         try:
-            for frame in rinput.obresult.frames:
-                hdulist = frame.open()
-                hdulist = basicflow(hdulist)
+            for hdulist in process_frames(rinput.obresult.frames, basicflow,
+                                          nworkers=rinput.nworkers,
+                                          prefetch=rinput.prefetch,
+                                          opener=opener):
                 cdata.append(hdulist)
 
             _logger.info('stacking %d images using median', len(cdata))
@@ -27,6 +27,7 @@ import numpy as np
 from scipy.interpolate import UnivariateSpline
 
 from megaradrp.trace.peakdetection import peak_detection_mean_window
+from megaradrp.trace.peakdetection import refine_peaks
 
 _logger = logging.getLogger('megara.trace')
 
@@ -75,17 +76,22 @@ def init_traces(y, center, x, ixmin, ixmax, background):
     #
     # peaks
 
+    pixmax = maxt[:, 0].astype('int')
+    # Take 2*2+1 pix
+    tx, py, valid = refine_peaks(y, pixmax, x=x, npoints=5)
+
     for fibid, trace in fiber_traces.items():
         trace.sample_c.append(center)
         trace.trace_c.append(maxt[fibid, 1])
         trace.peak_c.append(maxt[fibid, 2])
-        pixmax = int(maxt[fibid, 0])
-        # Take 2*2+1 pix
-        tx, py, _pos = delicate_centre(x[pixmax-2: pixmax+2+1],
-                                       y[pixmax-2: pixmax+2+1])
+        if not valid[fibid]:
+            # peaks near the border
+            pix = pixmax[fibid]
+            tx[fibid], py[fibid], _pos = delicate_centre(x[pix-2: pix+2+1],
+                                                         y[pix-2: pix+2+1])
         trace.sample_f.append(center)
-        trace.trace_f.append(tx)
-        trace.peak_f.append(py)
+        trace.trace_f.append(tx[fibid])
+        trace.peak_f.append(py[fibid])
     return fiber_traces
 
 
@@ -127,22 +133,16 @@ def explore_traces_common(data, x, cstart, cend, hs, fiber_traces,
         # pixel fraction peak
         # fit peaks
         fitt = maxt.copy()
-        for peakid in range(npeaks):
-            pixmax = int(maxt[peakid, 0])
-            # Take 2*2+1 pix
-            xi = x[pixmax-2: pixmax+2+1]
-            yi = colcut[pixmax-2: pixmax+2+1]
-            if xi.size < 5 or yi.size < 5:
-                fitt[peakid] = maxt[peakid]
-            else:
-                tx, py, pos = delicate_centre(xi, yi)
-                fitt[peakid, 1:] = [tx, py]
+        # Take 2*2+1 pix
+        tx, py, valid = refine_peaks(colcut, maxt[:, 0], x=x, npoints=5)
+        fitt[valid, 1] = tx[valid]
+        fitt[valid, 2] = py[valid]
         start = 0
         for fibid, trace in fiber_traces.items():
             if trace.lost is not None:
                 lost_count += 1
                 continue
-            _logger.debug('prev fib=%i is peak=%i', fibid, peakid)
+            _logger.debug('search fib=%i from peak=%i', fibid, start)
 
             # predict position for this trace in this position
             pos = trace.predict_position(c)
@@ -193,6 +193,156 @@ def explore_traces_common(data, x, cstart, cend, hs, fiber_traces,
                       c, npeaks, lost_count)
 
 
+def collapse_columns(data, centers, hs):
+    '''Mean of the columns in windows around centers.
+
+    The window of center c covers the columns c - hs to c + hs - 1,
+    clipped to the image. The sums of all the windows are computed from
+    cumulative sums along the wavelength axis, at the window borders.
+
+    :return: an array with shape (len(centers), rows)
+    '''
+    centers = np.asarray(centers, dtype='int')
+    ncols = data.shape[1]
+    lower = np.clip(centers - hs, 0, ncols)
+    upper = np.clip(centers + hs, 0, ncols)
+
+    # cumulative sums at the borders of the windows
+    points = np.union1d([0, ncols], np.concatenate([lower, upper]))
+    blocks = np.add.reduceat(data, points[:-1], axis=1, dtype='float64')
+    csum = np.zeros((data.shape[0], len(points)))
+    np.cumsum(blocks, axis=1, out=csum[:, 1:])
+
+    sums = (csum[:, np.searchsorted(points, upper)] -
+            csum[:, np.searchsorted(points, lower)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (sums / (upper - lower)).T
+
+
+def match_peaks(peaks, positions, maxdis):
+    '''Match predicted positions of fibers with peaks.
+
+    The fibers are matched in order, each one with the first peak,
+    after the peak matched with the previous fiber, nearer than maxdis,
+    as in explore_traces_common. A fiber is lost if the peaks get
+    farther from its position before one is found.
+
+    :return: the index of the peak of each fiber, -1 if lost
+    '''
+    peaks = np.asarray(peaks)
+    positions = np.asarray(positions)
+    npeaks = len(peaks)
+
+    result = np.full(len(positions), -1, dtype='int')
+    if npeaks == 0 or len(positions) == 0:
+        return result
+
+    if np.all(np.diff(peaks) > 0):
+        first = np.searchsorted(peaks, positions - maxdis, side='right')
+        cand = np.minimum(first, npeaks - 1)
+        matched = (first < npeaks) & (np.abs(peaks[cand] - positions) < maxdis)
+        # the search of each fiber starts after the previous match
+        prev = np.where(matched, first, -1)
+        prev = np.maximum.accumulate(np.concatenate([[-1], prev[:-1]]))
+        if np.all(first > prev):
+            result[matched] = first[matched]
+            return result
+
+    # conflicts or unsorted peaks, match one by one
+    start = 0
+    for idx, pos in enumerate(positions):
+        prev_dis = np.inf
+        for peakid in range(start, npeaks):
+            dis = abs(peaks[peakid] - pos)
+            if dis > prev_dis:
+                break
+            prev_dis = dis
+            if dis < maxdis:
+                result[idx] = peakid
+                start = peakid + 1
+                break
+    return result
+
+
+def explore_traces_image(data, x, cstart, cend, hs, fiber_traces,
+                         background, maxdis, npoints=5):
+    '''Explore the traces from cstart to cend, in steps of hs.
+
+    Equivalent to explore_traces_common, but the column cuts are computed
+    at once, the peaks are refined with closed-form parabolas and
+    the fibers are matched with vectorized searches.
+    '''
+
+    centers = np.arange(cstart, cend, hs)[1:]
+    hs = abs(hs)
+
+    fibids = list(fiber_traces.keys())
+    traces = [fiber_traces[fibid] for fibid in fibids]
+    nfibers = len(traces)
+
+    lost = np.array([trace.lost is not None for trace in traces],
+                    dtype='bool')
+    pos = np.array([np.nan if trace.lost is not None else trace.trace_f[-1]
+                    for trace in traces])
+
+    # columns of each fiber: raw position and value, fitted position and
+    # value, nan if not found
+    found = np.full((nfibers, len(centers), 4), np.nan)
+    lost_at = np.full(nfibers, -1, dtype='int')
+
+    colcuts = collapse_columns(data, centers, hs)
+
+    for cidx, (c, colcut) in enumerate(zip(centers, colcuts)):
+        # FIXME: background could be variable...
+        maxt = peak_detection_mean_window(colcut, x=x, k=3,
+                                          background=background)
+        npeaks = len(maxt)
+        _logger.debug('npeaks =%i, c=%i, hs=%i', npeaks, c, hs)
+        if npeaks == 0:
+            _logger.debug('no more peaks')
+            lost_at[~lost] = c
+            lost[:] = True
+            break
+
+        fitt = maxt.copy()
+        fpos, fval, valid = refine_peaks(colcut, maxt[:, 0], x=x,
+                                         npoints=npoints)
+        fitt[valid, 1] = fpos[valid]
+        fitt[valid, 2] = fval[valid]
+
+        active = np.flatnonzero(~lost)
+        peakid = match_peaks(fitt[:, 1], pos[active], maxdis)
+
+        newlost = active[peakid < 0]
+        lost_at[newlost] = c
+        lost[newlost] = True
+
+        fibers = active[peakid >= 0]
+        peakid = peakid[peakid >= 0]
+        found[fibers, cidx, 0] = maxt[peakid, 1]
+        found[fibers, cidx, 1] = maxt[peakid, 2]
+        found[fibers, cidx, 2] = fitt[peakid, 1]
+        found[fibers, cidx, 3] = fitt[peakid, 2]
+        pos[fibers] = fitt[peakid, 1]
+
+        _logger.debug('col = %i peaks = %i lost fibers = %i',
+                      c, npeaks, lost.sum())
+
+    for trace, ffound, flost in zip(traces, found, lost_at):
+        cols = np.flatnonzero(~np.isnan(ffound[:, 0]))
+        samples = centers[cols].tolist()
+        trace.sample_c.extend(samples)
+        trace.sample_f.extend(samples)
+        trace.trace_c.extend(ffound[cols, 0].tolist())
+        trace.peak_c.extend(ffound[cols, 1].tolist())
+        trace.trace_f.extend(ffound[cols, 2].tolist())
+        trace.peak_f.extend(ffound[cols, 3].tolist())
+        if flost >= 0:
+            trace.lost = int(flost)
+
+    return fiber_traces
+
+
 def domefun(image, maxdis=1.5, hs=5, cstart=None):
     '''
         hs: half size of the cut region
@@ -237,8 +387,8 @@ def domefun(image, maxdis=1.5, hs=5, cstart=None):
     cend1 = 50
     cend2 = wl_len
 
-    explore_traces_left(data, sp_x, cstart, cend1, hs,
-                        fiber_traces, background, maxdis)
+    explore_traces_image(data, sp_x, cstart, cend1, -hs,
+                         fiber_traces, background, maxdis)
 
     def reverse_trace(trace):
         trace.lost = None
@@ -253,7 +403,7 @@ def domefun(image, maxdis=1.5, hs=5, cstart=None):
     for trace in fiber_traces.values():
         reverse_trace(trace)
 
-    explore_traces_rigth(data, sp_x, cstart, cend2, hs,
+    explore_traces_image(data, sp_x, cstart, cend2, hs,
                          fiber_traces, background, maxdis)
 
     fit_traces = {key: fit_trace(trace, 5)
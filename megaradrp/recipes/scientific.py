@@ -19,24 +19,31 @@
 
 '''Calibration Recipes for Megara'''
 
+import functools
 import logging
 
 from astropy.io import fits
 
-from numina.core import Product, DataProductRequirement
+from numina.core import Product, DataProductRequirement, Parameter
 from numina.core.requirements import ObservationResultRequirement, Requirement
 from numina.array.combine import median as c_median
 from numina.flow import SerialFlow
 from numina.flow.processing import BiasCorrector
 
 from megaradrp.core import MegaraBaseRecipe
-from megaradrp.core import OverscanCorrector, TrimImage
+from megaradrp.core import OverscanTrimCorrector
 from megaradrp.core import ApertureExtractor, FiberFlatCorrector
 from megaradrp.core import ApertureExtractor2
+from megaradrp.core import process_frames, read_calibration, read_raw
+from megaradrp.combine import create_combiner
 
 # from numina.logger import log_to_history
 from megaradrp.requirements import MasterBiasRequirement
 from megaradrp.requirements import MasterFiberFlatRequirement
+from megaradrp.requirements import check_parameters
+from megaradrp.requirements import CombinationMethodParameter
+from megaradrp.requirements import NWorkersParameter, PrefetchParameter
+from megaradrp.requirements import OverscanParameter, SmoothParameter
 from megaradrp.products import MasterFiberFlat
 from megaradrp.products import MasterSensitivity,  TraceMap
 
@@ -54,6 +61,10 @@ class FiberMOSRecipe(MegaraBaseRecipe):
     traces = Requirement(TraceMap, 'Trace information of the Apertures')
     sensitivity = DataProductRequirement(
         MasterSensitivity, 'Sensitivity', optional=True)
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
 
     # Products
     final = Product(MasterFiberFlat)
@@ -67,29 +78,34 @@ class FiberMOSRecipe(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
+        check_parameters(rinput)
+
         _logger.info('starting fiber MOS reduction')
 
-        o_c = OverscanCorrector()
-        t_i = TrimImage()
+        o_t = OverscanTrimCorrector(overscan=rinput.overscan,
+                                    smooth=rinput.smooth)
 
-        with rinput.master_bias.open() as hdul:
-            mbias = hdul[0].data.copy()
+        with read_calibration(rinput.master_bias) as hdul:
+            mbias = hdul[0].data
             b_c = BiasCorrector(mbias)
 
         a_e = ApertureExtractor(rinput.traces)
 
-        with rinput.master_fiber_flat.open() as hdul:
+        with read_calibration(rinput.master_fiber_flat) as hdul:
             f_f_c = FiberFlatCorrector(hdul)
 
-        basicflow = SerialFlow([o_c, t_i, b_c, a_e, f_f_c])
+        basicflow = SerialFlow([o_t, b_c, a_e, f_f_c])
+        opener = functools.partial(read_raw, overscan=rinput.overscan,
+                                   smooth=rinput.smooth)
 
         t_data = []
         s_data = []
 
         try:
-            for frame in rinput.obresult.frames:
-                hdulist = frame.open()
-                hdulist = basicflow(hdulist)
+            for hdulist in process_frames(rinput.obresult.frames, basicflow,
+                                          nworkers=rinput.nworkers,
+                                          prefetch=rinput.prefetch,
+                                          opener=opener):
                 p_type = hdulist[0].header.get('OBSTYPE')
                 if p_type == 'SKY':
                     s_data.append(hdulist)
@@ -163,6 +179,12 @@ class FiberMOSRecipe2(MegaraBaseRecipe):
     traces = Requirement(TraceMap, 'Trace information of the Apertures')
     sensitivity = DataProductRequirement(
         MasterSensitivity, 'Sensitivity', optional=True)
+    nthreads = Parameter(1, 'Number of threads used in the extraction')
+    nworkers = NWorkersParameter()
+    prefetch = PrefetchParameter()
+    overscan = OverscanParameter()
+    smooth = SmoothParameter()
+    method = CombinationMethodParameter()
 
     # Products
     final = Product(MasterFiberFlat)
@@ -176,49 +198,54 @@ class FiberMOSRecipe2(MegaraBaseRecipe):
         )
 
     def run(self, rinput):
+        check_parameters(rinput)
+
         _logger.info('starting fiber MOS reduction')
 
-        o_c = OverscanCorrector()
-        t_i = TrimImage()
+        o_t = OverscanTrimCorrector(overscan=rinput.overscan,
+                                    smooth=rinput.smooth)
 
-        with rinput.master_bias.open() as hdul:
-            mbias = hdul[0].data.copy()
+        with read_calibration(rinput.master_bias) as hdul:
+            mbias = hdul[0].data
             b_c = BiasCorrector(mbias)
 
-        a_e = ApertureExtractor2(rinput.traces)
+        a_e = ApertureExtractor2(rinput.traces, nthreads=rinput.nthreads)
 
-        with rinput.master_fiber_flat.open() as hdul:
+        with read_calibration(rinput.master_fiber_flat) as hdul:
             f_f_c = FiberFlatCorrector(hdul)
 
-        basicflow = SerialFlow([o_c, t_i, b_c, a_e, f_f_c])
+        basicflow = SerialFlow([o_t, b_c, a_e, f_f_c])
+        opener = functools.partial(read_raw, overscan=rinput.overscan,
+                                   smooth=rinput.smooth)
 
-        t_data = []
-        s_data = []
+        t_comb = create_combiner(rinput.method)
+        s_comb = create_combiner(rinput.method)
 
-        try:
-            for frame in rinput.obresult.frames:
-                hdulist = frame.open()
-                hdulist = basicflow(hdulist)
+        for hdulist in process_frames(rinput.obresult.frames, basicflow,
+                                      nworkers=rinput.nworkers,
+                                      prefetch=rinput.prefetch,
+                                      opener=opener):
+            try:
                 p_type = hdulist[0].header.get('OBSTYPE')
                 if p_type == 'SKY':
-                    s_data.append(hdulist)
+                    s_comb.add(hdulist)
                 else:
-                    t_data.append(hdulist)
+                    t_comb.add(hdulist)
+            finally:
+                hdulist.close()
 
-            _logger.info('stacking %d sky images using median', len(s_data))
+        _logger.info('stacking %d sky images using %s', s_comb.nframes,
+                     rinput.method)
 
-            data_s = c_median([d[0].data for d in s_data], dtype='float32')
-            template_header = s_data[0][0].header
-            hdu_s = fits.PrimaryHDU(data_s[0], header=template_header)
+        data_s = s_comb.combine(dtype='float32')
+        hdu_s = fits.PrimaryHDU(data_s[0], header=s_comb.header)
 
-            data_t = c_median([d[0].data for d in t_data], dtype='float32')
-            template_header = t_data[0][0].header
-            hdu_t = fits.PrimaryHDU(data_t[0], header=template_header)
-        finally:
-            for hdulist in t_data:
-                hdulist.close()
-            for hdulist in s_data:
-                hdulist.close()
+        _logger.info('stacking %d target images using %s', t_comb.nframes,
+                     rinput.method)
+
+        data_t = t_comb.combine(dtype='float32')
+        template_header = t_comb.header
+        hdu_t = fits.PrimaryHDU(data_t[0], header=template_header)
 
         wlr = (3673.12731884058, 4417.497427536232)
         size = hdu_t.data.shape[1]
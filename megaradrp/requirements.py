@@ -19,9 +19,12 @@
 
 '''Typical requirements of recipes'''
 
-from numina.core import DataProductRequirement
+from numina.core import DataProductRequirement, Parameter
+from numina.core import RecipeError
 
 from .products import MasterBias, MasterDark, MasterFiberFlat
+from .core import OVERSCAN_MODES
+from .combine import COMBINE_METHODS
 
 
 class MasterBiasRequirement(DataProductRequirement):
@@ -45,3 +48,81 @@ class MasterFiberFlatRequirement(DataProductRequirement):
               self).__init__(MasterFiberFlat,
                              'Master fiber flat calibration'
                              )
+
+
+class CombinationMethodParameter(Parameter):
+    def __init__(self):
+        super(CombinationMethodParameter,
+              self).__init__('median',
+                             "Combination method, 'median', 'mean', "
+                             "'wmean' (weighted with the exposure time) "
+                             "or 'sigmaclip'"
+                             )
+
+
+class BlocksizeParameter(Parameter):
+    def __init__(self):
+        super(BlocksizeParameter,
+              self).__init__(0,
+                             'Number of rows combined at once, '
+                             '0 combines the full stack in memory'
+                             )
+
+
+class NWorkersParameter(Parameter):
+    def __init__(self):
+        super(NWorkersParameter,
+              self).__init__(1, 'Number of frames processed in parallel')
+
+
+class PrefetchParameter(Parameter):
+    def __init__(self):
+        super(PrefetchParameter,
+              self).__init__(1,
+                             'Number of frames read ahead in the background'
+                             )
+
+
+class OverscanParameter(Parameter):
+    def __init__(self):
+        super(OverscanParameter,
+              self).__init__('scalar',
+                             "Overscan model, 'scalar' (a level per "
+                             "amplifier) or 'row' (a level per row)"
+                             )
+
+
+class SmoothParameter(Parameter):
+    def __init__(self):
+        super(SmoothParameter,
+              self).__init__(0,
+                             'Number of rows in the running mean of the '
+                             'row overscan, 0 does not smooth'
+                             )
+
+
+def check_parameters(rinput):
+    '''Check the processing parameters of the input of a recipe.
+
+    The parameters shared by the recipes (method, blocksize, nthreads,
+    nworkers, prefetch, overscan and smooth) are checked, if the recipe
+    declares them, before any frame is read. RecipeError is raised
+    for the first parameter that is not valid.
+    '''
+
+    method = getattr(rinput, 'method', 'median')
+    if method not in COMBINE_METHODS:
+        raise RecipeError('invalid combination method %r' % method)
+    if getattr(rinput, 'blocksize', 0) < 0:
+        raise RecipeError('blocksize must not be negative')
+    if getattr(rinput, 'nthreads', 1) < 1:
+        raise RecipeError('nthreads must be positive')
+    if getattr(rinput, 'nworkers', 1) < 1:
+        raise RecipeError('nworkers must be positive')
+    if getattr(rinput, 'prefetch', 0) < 0:
+        raise RecipeError('prefetch must not be negative')
+    overscan = getattr(rinput, 'overscan', 'scalar')
+    if overscan not in OVERSCAN_MODES:
+        raise RecipeError('invalid overscan mode %r' % overscan)
+    if getattr(rinput, 'smooth', 0) < 0:
+        raise RecipeError('smooth must not be negative')
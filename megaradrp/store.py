@@ -19,25 +19,53 @@
 
 import logging
 
+import numpy
 import yaml
+from astropy.io import fits
 
 from numina.store import dump, load
 
-from .products import TraceMap
+from .products import TraceMap, TraceTable
 
 _logger = logging.getLogger('megaradrp')
 
 
+def tracemap_to_table(tracemap):
+    '''Binary table with the traces of a trace map.'''
+
+    traces = TraceTable.from_list(tracemap)
+    ncoef = traces.coeffs.shape[1]
+
+    cols = [fits.Column(name='FIBID', format='J', array=traces.fibid),
+            fits.Column(name='BOXID', format='J', array=traces.boxid),
+            fits.Column(name='START', format='J', array=traces.start),
+            fits.Column(name='STOP', format='J', array=traces.stop),
+            fits.Column(name='FITPARMS', format='%dD' % ncoef,
+                        array=traces.coeffs)]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    hdu.header['EXTNAME'] = 'TRACEMAP'
+    return hdu
+
+
+def tracemap_from_table(table):
+    '''Trace map from the rows of a binary table.'''
+
+    columns = [numpy.asarray(table.field(key), dtype='=i8')
+               for key in ['FIBID', 'BOXID', 'START', 'STOP']]
+    coeffs = numpy.asarray(table.field('FITPARMS'), dtype='=f8')
+    return TraceTable(*columns, coeffs=coeffs)
+
+
 _logger.debug('register dump functions')
 
 
 @dump.register(TraceMap)
 def _d(tag, obj, where):
 
-    filename = where.destination + '.yaml'
+    filename = where.destination + '.fits'
 
-    with open(filename, 'w') as fd:
-        yaml.dump(obj, fd)
+    hdul = fits.HDUList([fits.PrimaryHDU(), tracemap_to_table(obj)])
+    hdul.writeto(filename, clobber=True)
 
     return filename
 
@@ -47,7 +75,11 @@ _logger.debug('register load functions')
 @load.register(TraceMap)
 def _l(tag, obj):
 
-    with open(obj, 'r') as fd:
-        traces = yaml.load(fd)
+    # trace maps stored by older versions
+    if obj.endswith('.yaml'):
+        with open(obj, 'r') as fd:
+            traces = yaml.safe_load(fd)
+        return TraceTable.from_list(traces)
 
-    return traces
+    with fits.open(obj) as hdul:
+        return tracemap_from_table(hdul['TRACEMAP'].data)
@@ -0,0 +1,142 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests for the combine module.'''
+
+import numpy
+from astropy.io import fits
+
+from numina.core import DataFrame
+from numina.array.combine import median as c_median
+from numina.array.combine import sigmaclip as c_sigmaclip
+
+from megaradrp.combine import combine_blocks, combine_frames
+from megaradrp.combine import create_combiner
+
+
+def create_frames(nframes, shape, seed=12):
+    rng = numpy.random.RandomState(seed)
+    frames = []
+    for _ in range(nframes):
+        data = rng.normal(1000.0, 10.0, size=shape).astype('float32')
+        frames.append(DataFrame(frame=fits.HDUList([fits.PrimaryHDU(data)])))
+    return frames
+
+
+def test_combine_blocks():
+
+    frames = create_frames(5, (37, 20))
+    arrays = [frame.open()[0].data.copy() for frame in frames]
+
+    result = c_median(arrays, dtype='float32')
+
+    def flow(hdulist):
+        return hdulist
+
+    for blocksize in [1, 8, 37, 100]:
+        frames = create_frames(5, (37, 20))
+        data, _ = combine_blocks(c_median, frames, flow, blocksize=blocksize)
+        assert data.shape == result.shape
+        assert numpy.all(data == result)
+
+    frames = create_frames(5, (37, 20))
+    data, _ = combine_blocks(c_median, frames, flow, blocksize=8, nworkers=3,
+                             inflight=2)
+    assert numpy.all(data == result)
+
+    frames = create_frames(5, (37, 20))
+    data, _ = combine_blocks(c_median, frames, flow, blocksize=8, nworkers=2,
+                             prefetch=2)
+    assert numpy.all(data == result)
+
+
+def test_mean_combiner():
+
+    frames = create_frames(7, (13, 11))
+    arrays = numpy.array([frame.open()[0].data for frame in frames],
+                         dtype='float64')
+    exptimes = numpy.arange(1.0, 8.0)
+
+    combiner = create_combiner('mean')
+    for frame in frames:
+        combiner.add(frame.open())
+    data = combiner.combine(dtype='float64')
+
+    assert combiner.nframes == 7
+    assert numpy.allclose(data[0], arrays.mean(axis=0))
+    assert numpy.allclose(data[1], arrays.var(axis=0, ddof=1))
+    assert numpy.all(data[2] == 7)
+
+    combiner = create_combiner('wmean')
+    for frame, exptime in zip(frames, exptimes):
+        hdulist = frame.open()
+        hdulist[0].header['EXPTIME'] = exptime
+        combiner.add(hdulist)
+    data = combiner.combine(dtype='float64')
+
+    mean = numpy.average(arrays, axis=0, weights=exptimes)
+    var = (exptimes[:, None, None] * (arrays - mean) ** 2).sum(axis=0)
+    var /= exptimes.sum() - (exptimes ** 2).sum() / exptimes.sum()
+    assert numpy.allclose(data[0], mean)
+    assert numpy.allclose(data[1], var)
+
+
+def test_sigmaclip():
+
+    frames = create_frames(25, (13, 11))
+    arrays = [frame.open()[0].data.copy() for frame in frames]
+
+    combiner = create_combiner('sigmaclip')
+    for frame in frames:
+        combiner.add(frame.open())
+    assert numpy.all(combiner.combine() == c_sigmaclip(arrays,
+                                                       dtype='float32'))
+
+    frames[4].open()[0].data[3, 5] = 1e5
+    combiner = create_combiner('sigmaclip')
+    for frame in frames:
+        combiner.add(frame.open())
+    data = combiner.combine(dtype='float64')
+    good = numpy.array(arrays[:4] + arrays[5:], dtype='float64')
+
+    assert data[2, 3, 5] == 24
+    assert numpy.isclose(data[0, 3, 5], good[:, 3, 5].mean())
+
+
+def test_combine_frames():
+
+    def flow(hdulist):
+        # an RSS extracted in double precision
+        hdulist[0].data = hdulist[0].data[::4].astype('float64')
+        return hdulist
+
+    for method in ['median', 'sigmaclip']:
+        frames = create_frames(5, (37, 20))
+        data, _ = combine_frames(method, frames, flow)
+        frames = create_frames(5, (37, 20))
+        bdata, _ = combine_frames(method, frames, flow, blocksize=4)
+        assert data.dtype == bdata.dtype == numpy.dtype('float32')
+        assert data.shape == (3, 10, 20)
+        assert numpy.all(data == bdata)
+
+    combiner = create_combiner('median')
+    for frame in create_frames(3, (37, 20)):
+        combiner.add(flow(frame.open()))
+    assert all(arr.dtype == numpy.dtype('float32')
+               for arr in combiner._arrays)
@@ -0,0 +1,176 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests for the core module.'''
+
+import os
+
+import numpy
+import pytest
+from astropy.io import fits
+
+from numina.core import DataFrame
+
+from megaradrp.core import trim_and_o_array, overscan_trim_array, read_raw
+from megaradrp.core import read_calibration, process_frames
+from megaradrp.core import OverscanTrimCorrector, header_geometry
+
+
+def create_raw(level1=100.0, level2=200.0):
+    '''Raw image with constant overscan levels.'''
+    rng = numpy.random.RandomState(1232)
+    data = numpy.empty((4212, 4196), dtype='float32')
+    data[:2106] = level1
+    data[2106:] = level2
+    science = rng.uniform(0, 1000, size=(4212, 4096)).astype('int16')
+    data[:2056, 50:4146] += science[:2056]
+    data[2156:, 50:4146] += science[2156:]
+    return data
+
+
+def test_overscan_trim_array():
+    data = create_raw()
+    result = overscan_trim_array(data)
+    trimmed = trim_and_o_array(data)
+
+    assert result.shape == (4112, 4096)
+    assert result.dtype == numpy.float32
+    assert numpy.allclose(result[:2056], trimmed[:2056] - 100.0)
+    assert numpy.allclose(result[2056:], trimmed[2056:] - 200.0)
+
+    out = numpy.empty_like(result)
+    result2 = overscan_trim_array(data, out=out)
+    assert result2 is out
+    assert numpy.all(result2 == result)
+
+
+def test_read_raw(tmpdir):
+    data = create_raw()
+    filename = str(tmpdir.join('raw.fits'))
+    hdu = fits.PrimaryHDU((data - 32768).astype('int16'))
+    hdu.header['BZERO'] = 32768
+    hdu.writeto(filename)
+
+    hdulist = read_raw(DataFrame(filename=filename))
+    result = hdulist[0].data
+
+    assert 'BZERO' not in hdulist[0].header
+    assert 'NUM-OVPE' in hdulist[0].header
+    assert 'NUM-TRIM' in hdulist[0].header
+    assert numpy.allclose(result, overscan_trim_array(data))
+
+
+def test_read_calibration(tmpdir):
+    filename = str(tmpdir.join('master_bias.fits'))
+    data = numpy.arange(12.0, dtype='>f4').reshape((3, 4))
+    fits.PrimaryHDU(data).writeto(filename)
+
+    frame = DataFrame(filename=filename)
+    with read_calibration(frame) as hdulist:
+        first = hdulist[0].data
+    with read_calibration(frame) as hdulist:
+        second = hdulist[0].data
+
+    assert numpy.all(first == data)
+    assert first.dtype.isnative
+    assert not first.flags.writeable
+    assert first.base is second.base
+
+    # the file has changed
+    tmpdir.join('master_bias.fits').remove()
+    fits.PrimaryHDU(numpy.ones((5, 4))).writeto(filename)
+    with read_calibration(frame) as hdulist:
+        assert numpy.all(hdulist[0].data == 1)
+
+    # rewritten in place with the same size and modification time
+    stat = os.stat(filename)
+    with open(filename, 'r+b') as fd:
+        fd.write(fits.PrimaryHDU(numpy.zeros((5, 4))).header.tostring()
+                 .encode('ascii'))
+        fd.write(numpy.zeros((5, 4), dtype='>f8').tobytes())
+    os.utime(filename, (stat.st_atime, stat.st_mtime))
+    assert os.stat(filename).st_size == stat.st_size
+    assert os.stat(filename).st_mtime == stat.st_mtime
+    with read_calibration(frame) as hdulist:
+        assert numpy.all(hdulist[0].data == 0)
+
+
+def test_overscan_trim_corrector():
+    data = create_raw()
+    hdulist = fits.HDUList([fits.PrimaryHDU(data.copy())])
+
+    node = OverscanTrimCorrector()
+    hdulist = node(hdulist)
+
+    assert 'NUM-OVPE' in hdulist[0].header
+    assert 'NUM-TRIM' in hdulist[0].header
+    assert numpy.all(hdulist[0].data == overscan_trim_array(data))
+
+
+def test_overscan_trim_array_row():
+    data = create_raw()
+    # add a gradient along the rows
+    ramp = numpy.linspace(0, 20, 4212).astype('float32')
+    data += ramp[:, numpy.newaxis]
+
+    result = overscan_trim_array(data, overscan='row')
+    trimmed = trim_and_o_array(data)
+
+    expected = trimmed.copy()
+    expected[:2056] -= 100.0 + ramp[:2056, numpy.newaxis]
+    expected[2056:] -= 200.0 + ramp[2156:, numpy.newaxis]
+    assert numpy.allclose(result, expected, atol=1e-3)
+
+    smoothed = overscan_trim_array(data, overscan='row', smooth=5)
+    assert numpy.allclose(smoothed, expected, atol=1e-2)
+
+
+def test_header_geometry():
+    header = fits.Header()
+    geom = header_geometry(header, (4212, 4196))
+    assert geom.bins == '11'
+    assert geom.direction == 'normal'
+    assert geom.tshape == (4112, 4096)
+    assert header_geometry(header, (4212, 4196)) is geom
+
+    header['CCDBIN1'] = 2
+    header['CCDBIN2'] = 2
+    header['READDIR'] = 'mirror'
+    geom = header_geometry(header, (2106, 2098))
+    assert geom.bins == '22'
+    assert geom.direction == 'mirror'
+    assert geom.tshape == (2056, 2048)
+
+    # binned only along the columns, the prescan is 25 columns wide
+    header['CCDBIN2'] = 1
+    geom = header_geometry(header, (4212, 2098))
+    assert geom.bins == '21'
+    assert geom.tshape == (4112, 2048)
+    amp1, amp2 = geom.amps
+    assert amp1.trim[1] == slice(25, 2073)
+    assert amp1.pcol[1] == slice(0, 25)
+    assert amp1.orow[0] == slice(2056, 2106)
+
+
+def test_process_frames_arguments():
+    # the arguments are checked before any frame is taken
+    with pytest.raises(ValueError):
+        process_frames([], None, nworkers=0)
+    with pytest.raises(ValueError):
+        process_frames([], None, prefetch=-1)
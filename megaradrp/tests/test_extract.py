@@ -0,0 +1,122 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Tests for the extraction of apertures.'''
+
+import numpy
+
+from megaradrp.trace.extract import superex, superex_batch
+from megaradrp.trace.extract import extraction_weights, superex_stack
+from megaradrp.core import apextract2
+
+
+def test_superex_batch():
+    rng = numpy.random.RandomState(9812)
+    data = rng.normal(100, 10, size=(200, 300)).astype('float32')
+
+    lower = numpy.array([[1e-5, 0.01, -0.3 + 6.5 * i] for i in range(31)])
+    upper = lower + [0, 0, 6.5]
+
+    borders = [(numpy.poly1d(l), numpy.poly1d(u))
+               for l, u in zip(lower, upper)]
+
+    expected = superex(data, borders)
+    result = superex_batch(data, lower, upper)
+    assert numpy.all(result == expected)
+
+    result = superex_batch(data, lower, upper, cache=False)
+    assert numpy.all(result == expected)
+
+    swapped = data.astype('>f4')
+    assert numpy.all(superex_batch(swapped, lower, upper) == expected)
+
+
+def test_superex_batch_threads():
+    rng = numpy.random.RandomState(3321)
+    data = rng.normal(100, 10, size=(200, 300))
+
+    lower = numpy.array([[0.01, -0.3 + 6.5 * i] for i in range(31)])
+    upper = lower + [0, 6.5]
+
+    expected = superex_batch(data, lower, upper)
+    for nthreads in [2, 3, 64]:
+        result = superex_batch(data, lower, upper, nthreads=nthreads)
+        assert numpy.all(result == expected)
+        result = superex_batch(data, lower, upper, nthreads=nthreads,
+                               cache=False)
+        assert numpy.all(result == expected)
+
+
+def test_extraction_weights_cache():
+    lower = numpy.array([[0.01, -0.3 + 6.5 * i] for i in range(31)])
+    upper = lower + [0, 6.5]
+
+    weights = extraction_weights(lower, upper, (200, 300))
+    assert extraction_weights(lower, upper, (200, 300)) is weights
+    assert extraction_weights(lower, upper, (210, 300)) is not weights
+    assert extraction_weights(lower + 1, upper, (200, 300)) is not weights
+    assert extraction_weights(lower, upper, (200, 300), cache=False) is not weights
+
+
+def test_superex_stack(tmpdir):
+    rng = numpy.random.RandomState(1092)
+    data = rng.normal(100, 10, size=(3, 200, 300)).astype('float32')
+
+    lower = numpy.array([[0.01, -0.3 + 6.5 * i] for i in range(31)])
+    upper = lower + [0, 6.5]
+
+    stack = numpy.memmap(str(tmpdir.join('stack')), dtype='float32',
+                         mode='w+', shape=data.shape)
+    stack[:] = data
+    stack.flush()
+    stack = numpy.memmap(str(tmpdir.join('stack')), dtype='float32',
+                         mode='r', shape=data.shape)
+
+    for nthreads in [1, 2]:
+        result = superex_stack(stack, lower, upper, nthreads=nthreads)
+        assert result.shape == (3, 31, 300)
+        for frame, rss in zip(data, result):
+            assert numpy.all(rss == superex_batch(frame, lower, upper))
+
+    result = superex_stack(data.astype('>f4'), lower, upper)
+    for frame, rss in zip(data, result):
+        assert numpy.all(rss == superex_batch(frame, lower, upper))
+
+
+def test_apextract2_two_traces():
+    rng = numpy.random.RandomState(4410)
+    data = rng.normal(100, 10, size=(40, 300)).astype('float32')
+
+    tracemap = [{'fibid': 1, 'boxid': 1, 'start': 0, 'stop': 299,
+                 'fitparms': [1e-5, 0.01, 15.2]},
+                {'fibid': 2, 'boxid': 1, 'start': 0, 'stop': 299,
+                 'fitparms': [1e-5, 0.01, 21.9]}]
+    p0, p1 = [numpy.poly1d(t['fitparms']) for t in tracemap]
+    mid = 0.5 * (p0 + p1)
+    borders = [(1.5 * p0 - 0.5 * p1, mid), (mid, 2 * p1 - mid)]
+
+    result = apextract2(data, tracemap)
+    assert numpy.all(result == superex(data, borders))
+
+    # the last of three traces is not extracted
+    tracemap.append({'fibid': 3, 'boxid': 1, 'start': 0, 'stop': 299,
+                     'fitparms': [1e-5, 0.01, 28.4]})
+    result = apextract2(data, tracemap)
+    assert numpy.all(result[-1] == 0)
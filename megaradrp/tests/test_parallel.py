@@ -0,0 +1,104 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Tests for the parallel module.'''
+
+import threading
+import time
+
+import pytest
+
+from megaradrp.parallel import imap_ordered, read_ahead
+
+
+def test_imap_ordered():
+
+    lock = threading.Lock()
+    state = {'taken': 0, 'maxtaken': 0}
+
+    def items():
+        for idx in range(30):
+            with lock:
+                state['taken'] += 1
+                state['maxtaken'] = max(state['maxtaken'], state['taken'])
+            yield idx
+
+    def func(idx):
+        # the late items finish first
+        time.sleep(0.001 * (idx % 4))
+        return idx * idx
+
+    result = []
+    for value in imap_ordered(func, items(), nworkers=3, inflight=4):
+        result.append(value)
+        with lock:
+            state['taken'] -= 1
+
+    assert result == [idx * idx for idx in range(30)]
+    assert state['maxtaken'] <= 4
+
+
+def test_imap_ordered_error():
+
+    def func(idx):
+        if idx == 5:
+            raise ValueError('bad item')
+        return idx
+
+    result = []
+    with pytest.raises(ValueError):
+        for value in imap_ordered(func, range(10), nworkers=2):
+            result.append(value)
+
+    assert result == list(range(5))
+
+
+def test_read_ahead():
+
+    lock = threading.Lock()
+    state = {'read': 0, 'used': 0, 'ahead': 0}
+
+    def func(idx):
+        with lock:
+            state['read'] += 1
+            state['ahead'] = max(state['ahead'],
+                                 state['read'] - state['used'])
+        return idx + 1
+
+    result = []
+    for value in read_ahead(func, range(20), depth=3):
+        time.sleep(0.002)
+        result.append(value)
+        with lock:
+            state['used'] += 1
+
+    assert result == list(range(1, 21))
+    assert state['ahead'] <= 4
+
+    def bad(idx):
+        if idx == 2:
+            raise ValueError('bad item')
+        return idx
+
+    result = []
+    with pytest.raises(ValueError):
+        for value in read_ahead(bad, range(10)):
+            result.append(value)
+    assert result == [0, 1]
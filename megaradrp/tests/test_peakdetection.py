@@ -0,0 +1,143 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Tests for the peak detection filters.'''
+
+import numpy
+from scipy.ndimage import generic_filter
+
+from megaradrp.trace.peakdetection import _vecS1, _vecS2
+from megaradrp.trace.peakdetection import peak_detection_mean_window
+from megaradrp.trace.peakdetection import peakdet, peakdet_batch
+from megaradrp.trace.peakdetection import peak_detection_basic, refine_peaks
+
+
+def test_filters_generic():
+    '''The filters give the same values of generic_filter.'''
+
+    def max_filter(x):
+        return x[k] - 0.5 * (x[:k].max() + x[k+1:].max())
+
+    def mean_filter(x):
+        return x[k] - 0.5 * (x[:k].mean() + x[k+1:].mean())
+
+    rng = numpy.random.RandomState(2231)
+    for dtype in ['float64', 'float32', 'int32']:
+        for k, size in [(1, 100), (3, 500), (9, 500), (5, 4)]:
+            data = rng.normal(1000, 300, size=size).astype(dtype)
+            expected = generic_filter(data, max_filter, size=2 * k + 1)
+            assert numpy.all(_vecS1(k, data) == expected)
+            expected = generic_filter(data, mean_filter, size=2 * k + 1)
+            assert numpy.all(_vecS2(k, data) == expected)
+
+
+def test_peak_detection_mean_window():
+    y = numpy.zeros(80)
+    y[[10, 20, 40, 60]] = 100.0
+    y[21] = 50.0
+
+    result = peak_detection_mean_window(y, k=3)
+    # the close peaks are merged, the last candidate is not used
+    assert numpy.all(result[:, 0] == [10, 20, 40])
+    assert numpy.all(result[:, 2] == 100.0)
+
+    result = peak_detection_mean_window(y, k=3, xmin=15)
+    assert numpy.all(result[:, 0] == [20, 40])
+
+    assert len(peak_detection_mean_window(y, k=3, background=200)) == 0
+
+
+def test_peakdet():
+    v = numpy.array([0, 1, 5, 2, 1, 7, 8, 3, 0, 4, 1], dtype='float32')
+    maxtab, mintab = peakdet(v, delta=1.5)
+    assert numpy.all(maxtab == [[2, 5], [6, 8], [9, 4]])
+    assert numpy.all(mintab == [[4, 1], [8, 0]])
+
+    maxtab, mintab = peakdet(v, delta=1.5, x=numpy.arange(11) + 10.0,
+                             back=0.5)
+    assert numpy.all(maxtab == [[12, 5], [16, 8], [19, 4]])
+
+    # a peak is found in the first point over the background
+    # and delta below the maximum
+    maxtab, mintab = peakdet(v, delta=1.5, back=3.5)
+    assert numpy.all(maxtab == [[6, 8]])
+
+    assert numpy.all(peak_detection_basic(v, delta=1.5) ==
+                     peakdet(v, delta=1.5)[0])
+
+
+def test_peakdet_batch():
+    rng = numpy.random.RandomState(981)
+    profiles = rng.normal(100, 50, size=(20, 300))
+
+    result = peakdet_batch(profiles, 10.0, back=20.0)
+    assert len(result) == 20
+    for profile, (maxtab, mintab) in zip(profiles, result):
+        emaxtab, emintab = peakdet(profile, 10.0, back=20.0)
+        assert numpy.all(maxtab == emaxtab)
+        assert numpy.all(mintab == emintab)
+
+
+def test_refine_peaks():
+    rng = numpy.random.RandomState(1123)
+    y = rng.uniform(0, 100, size=50)
+    pixmax = numpy.array([0, 1, 2, 10, 25, 47, 48, 49])
+    x = numpy.arange(50) + 100.0
+
+    for npoints in [3, 5]:
+        pos, val, valid = refine_peaks(y, pixmax, x=x, npoints=npoints)
+        half = npoints // 2
+        assert numpy.all(valid == ((pixmax >= half) & (pixmax < 50 - half)))
+        for p, v, pix in zip(pos[valid], val[valid], pixmax[valid]):
+            region = slice(pix - half, pix + half + 1)
+            coeffs = numpy.polyfit(x[region], y[region], deg=2)
+            xc = -coeffs[1] / (2 * coeffs[0])
+            assert numpy.allclose(p, xc, rtol=0, atol=1e-8)
+            assert numpy.allclose(v, numpy.polyval(coeffs, xc))
+
+
+def test_refine_peaks_methods():
+    rows = numpy.arange(40)
+    centers = numpy.array([10.3, 20.0, 29.6])
+    image = numpy.zeros((40, 3))
+    for col, center in enumerate(centers):
+        image[:, col] = 500 * numpy.exp(-0.5 * ((rows - center) / 1.5) ** 2)
+    pixmax = numpy.array([10, 20, 30])
+    columns = numpy.array([0, 1, 2])
+
+    # gaussian fit is exact for gaussian profiles
+    pos, val, valid = refine_peaks(image, pixmax, npoints=3,
+                                   method='gaussian', columns=columns)
+    assert numpy.all(valid)
+    assert numpy.allclose(pos, centers)
+    assert numpy.allclose(val, 500)
+
+    for npoints in [3, 5]:
+        pos, val, valid = refine_peaks(image, pixmax, npoints=npoints,
+                                       method='barycentre', columns=columns)
+        assert numpy.all(valid)
+        assert numpy.all(numpy.abs(pos - centers) < 0.4)
+        assert numpy.all(val == image[pixmax, columns])
+
+    # the profile, column by column
+    for col in columns:
+        pos, val, valid = refine_peaks(image[:, col], pixmax[col:col + 1],
+                                       method='gaussian', npoints=5)
+        assert numpy.allclose(pos, centers[col])
@@ -0,0 +1,45 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests for the checks of the recipe parameters.'''
+
+import pytest
+
+from numina.core import RecipeError
+
+from megaradrp.requirements import check_parameters
+
+
+class RecipeInput(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_check_parameters():
+    check_parameters(RecipeInput())
+    check_parameters(RecipeInput(method='sigmaclip', blocksize=0, nthreads=2,
+                                 nworkers=3, prefetch=0, overscan='row',
+                                 smooth=5))
+
+    invalid = [{'method': 'mode'}, {'blocksize': -1}, {'nthreads': 0},
+               {'nworkers': 0}, {'prefetch': -1}, {'overscan': 'column'},
+               {'smooth': -2}]
+    for kwargs in invalid:
+        with pytest.raises(RecipeError):
+            check_parameters(RecipeInput(**kwargs))
@@ -0,0 +1,91 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests for the storage of products.'''
+
+import numpy
+import yaml
+from astropy.io import fits
+
+from megaradrp.products import TraceMap, TraceTable
+from megaradrp.store import tracemap_to_table, load
+from megaradrp.core import trace_coefficients
+
+
+def create_tracemap(ntraces=12):
+    rng = numpy.random.RandomState(1331)
+    tracemap = []
+    for idx in range(ntraces):
+        tracemap.append({'fibid': idx + 1, 'boxid': idx // 4 + 1,
+                         'start': 0, 'stop': 4095,
+                         'fitparms': rng.normal(size=6).tolist()})
+    return tracemap
+
+
+def test_tracemap_table(tmpdir):
+    tracemap = create_tracemap()
+    filename = str(tmpdir.join('traces.fits'))
+    fits.HDUList([fits.PrimaryHDU(),
+                  tracemap_to_table(tracemap)]).writeto(filename)
+
+    result = load(TraceMap(), filename)
+    assert isinstance(result, TraceTable)
+    assert result.to_list() == tracemap
+    assert numpy.all(result.coeffs == trace_coefficients(tracemap))
+    assert trace_coefficients(result) is result.coeffs
+
+    filename = str(tmpdir.join('empty.fits'))
+    fits.HDUList([fits.PrimaryHDU(),
+                  tracemap_to_table([])]).writeto(filename)
+    assert len(load(TraceMap(), filename)) == 0
+
+    # maps stored by older versions
+    filename = str(tmpdir.join('traces.yaml'))
+    with open(filename, 'w') as fd:
+        yaml.dump(tracemap, fd)
+    assert load(TraceMap(), filename).to_list() == tracemap
+
+
+def test_tracetable():
+    tracemap = create_tracemap()
+    traces = TraceTable.from_list(tracemap)
+
+    assert not hasattr(traces, '__dict__')
+    assert len(traces) == len(tracemap)
+    assert list(traces) == tracemap
+    assert traces[3] == tracemap[3]
+
+    box = traces.box(2)
+    assert box.to_list() == [t for t in tracemap if t['boxid'] == 2]
+    assert traces[2:5].to_list() == tracemap[2:5]
+
+    # empty tables
+    empty = traces.box(max(t['boxid'] for t in tracemap) + 1)
+    assert len(empty) == 0
+    assert empty.coeffs.shape == (0, traces.coeffs.shape[1])
+    assert len(traces[len(tracemap):]) == 0
+    assert TraceTable.from_list([]).to_list() == []
+    empty = TraceTable([], [], 0, 4095, [])
+    assert empty.evaluate([0.0, 10.0]).shape == (0, 2)
+
+    xx = numpy.array([0.0, 1000.5, 4095.0])
+    positions = traces.evaluate(xx)
+    assert positions.shape == (len(tracemap), len(xx))
+    for row, trace in zip(positions, tracemap):
+        assert numpy.all(row == numpy.polyval(trace['fitparms'], xx))
@@ -0,0 +1,164 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''Tests for the tracing of fibers.'''
+
+import numpy
+
+import pytest
+
+from megaradrp.trace.traces import init_traces, trace_all, polyfit_batch
+from megaradrp.trace.traces import trace_global
+from megaradrp.trace.traces import measure_offsets, trace_residuals
+from megaradrp.trace._traces import tracing
+from megaradrp.recipes.calibration.traces import match_peaks
+from megaradrp.recipes.calibration.traces import explore_traces_common
+from megaradrp.recipes.calibration.traces import explore_traces_image
+from megaradrp.recipes.calibration.traces import init_traces as calib_init_traces
+
+
+def create_flat(nfibers=40, shape=(350, 600), sep=7.5, offset=0.0):
+    '''Image with curved fiber profiles.'''
+    rng = numpy.random.RandomState(3123)
+    rows, cols = shape
+    xx = numpy.arange(cols) - 0.5 * cols
+    yy = numpy.arange(rows)[:, numpy.newaxis]
+    image = rng.normal(0, 3, size=shape)
+    for i in range(nfibers):
+        center = 10 + sep * i + 1e-5 * xx ** 2 + 1e-3 * xx + offset
+        image += 1000 * numpy.exp(-0.5 * ((yy - center) / 1.2) ** 2)
+    return image
+
+
+def test_trace_all():
+    image = create_flat()
+    peaks = init_traces(image, center=300, hs=1, background=10.0, npred=3)
+    starts = [trace.start for trace in peaks.values()]
+
+    expected = [tracing(image, x=x, y=y, p=p, step=2, hs=1,
+                        background=10.0, maxdis=2.0)
+                for x, y, p in starts]
+
+    for nthreads in [1, 4]:
+        points, offsets = trace_all(image, starts, step=2, hs=1,
+                                    background=10.0, maxdis=2.0,
+                                    nthreads=nthreads)
+        assert len(offsets) == len(starts) + 1
+        for idx, mm in enumerate(expected):
+            assert numpy.all(points[offsets[idx]:offsets[idx + 1]] == mm)
+
+
+def test_trace_global():
+    image = create_flat()
+    peaks = init_traces(image, center=300, hs=1, background=10.0, npred=3)
+    starts = [trace.start for trace in peaks.values()]
+
+    # the fibers are well separated, the traces are the same
+    expected, eoffsets = trace_all(image, starts, step=2, hs=1,
+                                   background=10.0, maxdis=2.0)
+    points, offsets = trace_global(image, starts, step=2, hs=1,
+                                   background=10.0, maxdis=2.0)
+    assert numpy.all(offsets == eoffsets)
+    assert numpy.all(points == expected)
+
+    # two traces starting in the same peak, the first one keeps it
+    x, y, p = starts[5]
+    points, offsets = trace_global(image, [(x, y, p), (x, y + 0.2, p)],
+                                   step=2, hs=1, tol=0,
+                                   background=10.0, maxdis=2.0)
+    first = expected[eoffsets[5]:eoffsets[6]]
+    assert numpy.all(points[offsets[0]:offsets[1]] == first)
+    assert offsets[2] - offsets[1] == 1
+
+    with pytest.raises(ValueError):
+        trace_global(image, [starts[0], (x + 1, y, p)])
+
+
+def test_measure_offsets():
+    image = create_flat()
+    peaks = init_traces(image, center=300, hs=1, background=10.0, npred=3)
+    starts = [trace.start for trace in peaks.values()]
+    points, offsets = trace_all(image, starts, step=2, hs=1,
+                                background=10.0, maxdis=2.0)
+    coeffs = polyfit_batch(points[:, 0], points[:, 1], offsets, deg=5)
+
+    shifted = create_flat(offset=0.7)
+    columns = [100, 200, 300, 400, 500]
+    groups = numpy.arange(len(coeffs)) // 10
+    labels, offs, tilts = measure_offsets(shifted, coeffs, columns,
+                                          groups=groups)
+    assert numpy.all(labels == [0, 1, 2, 3])
+    assert numpy.allclose(offs, 0.7, atol=0.05)
+    assert numpy.allclose(tilts, 0.0, atol=1e-4)
+
+    residuals = trace_residuals(shifted, coeffs, columns, hs=1)
+    assert numpy.allclose(residuals, 0.7, atol=0.1)
+    coeffs[:, -1] += 0.7
+    residuals = trace_residuals(shifted, coeffs, columns, hs=1)
+    assert numpy.allclose(residuals, 0.0, atol=0.1)
+
+
+def test_polyfit_batch():
+    rng = numpy.random.RandomState(9912)
+    counts = [300, 250, 4, 310]
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)])
+    x = numpy.concatenate([2000 + 2.0 * numpy.arange(n) - n for n in counts])
+    y = 10 + 1e-3 * x + 2e-7 * (x - 2000) ** 2 + rng.normal(0, 0.05, len(x))
+
+    result = polyfit_batch(x, y, offsets, deg=5)
+    assert result.shape == (4, 6)
+
+    for coeffs, l1, l2 in zip(result, offsets[:-1], offsets[1:]):
+        expected = numpy.polyfit(x[l1:l2], y[l1:l2], deg=5)
+        xx = x[l1:l2]
+        assert numpy.allclose(numpy.polyval(coeffs, xx),
+                              numpy.polyval(expected, xx), rtol=0, atol=1e-8)
+
+
+def test_match_peaks():
+    peaks = numpy.array([10.0, 17.5, 25.2, 26.0, 40.0])
+    positions = numpy.array([9.0, 17.0, 25.5, 33.0, 40.5])
+    # the first peak near enough is used, the second fiber
+    # cannot use the same peak
+    assert numpy.all(match_peaks(peaks, positions, 1.5) == [0, 1, 2, -1, 4])
+    assert numpy.all(match_peaks(peaks, [10.2, 10.4], 1.5) == [0, -1])
+
+
+def test_explore_traces_image():
+    image = create_flat()
+    xx = numpy.arange(image.shape[0])
+    cstart = 300
+    colcut = image[:, cstart - 4:cstart + 4].mean(axis=1)
+
+    results = []
+    for explore in [explore_traces_common, explore_traces_image]:
+        fiber_traces = calib_init_traces(colcut, cstart, xx, 10,
+                                         image.shape[0] - 10, 10.0)
+        explore(image, xx, cstart, 20, -4, fiber_traces, 10.0, 1.5)
+        explore(image, xx, cstart, image.shape[1], 4, fiber_traces,
+                10.0, 1.5)
+        results.append(fiber_traces)
+
+    expected, result = results
+    for fibid, trace in expected.items():
+        assert result[fibid].sample_f == trace.sample_f
+        assert result[fibid].trace_c == trace.trace_c
+        assert result[fibid].lost == trace.lost
+        assert numpy.allclose(result[fibid].trace_f, trace.trace_f)
@@ -43,6 +43,12 @@ namespace Numina {
     std::reverse(ptrace.begin(), ptrace.end());
   }
 
+  void Trace::reserve(size_t n) {
+    xtrace.reserve(n);
+    ytrace.reserve(n);
+    ptrace.reserve(n);
+  }
+
   double Trace::predict(double x) const {
 
     size_t n = std::min<size_t>(5, xtrace.size());
@@ -32,6 +32,7 @@ class Trace {
     double predict(double x) const;
     void push_back(double x, double y, double p);
     void reverse();
+    void reserve(size_t n);
     std::vector<double> xtrace;
     std::vector<double> ytrace;
     std::vector<double> ptrace;
@@ -1,15 +1,27 @@
 #
+import threading
+import hashlib
+from collections import OrderedDict
+
 import numpy
 
-from megaradrp.trace._extract import extract2
+from megaradrp.trace._extract import extract2, extract_all
+from megaradrp.trace._extract import aperture_weights, extract_weights
+from megaradrp.trace._extract import extract_stack
+from megaradrp.parallel import run_blocks
+
+# Weights of the last used trace maps
+_WEIGHTS_CACHE_SIZE = 4
+_weights_cache = OrderedDict()
+_weights_lock = threading.Lock()
 
 def superex(data, borders, out=None):
-    
+
     if data.dtype.byteorder != '=':
-        data2 = data.byteswap().newbyteorder()
+        data2 = data.astype(data.dtype.newbyteorder('='))
     else:
         data2 = data
-    
+
     if out is None:
         out = numpy.zeros((len(borders), data.shape[1]), dtype='float')
 
@@ -17,8 +29,166 @@ def superex(data, borders, out=None):
 
     for idx, (b1, b2) in enumerate(borders):
         bb1 = b1(xx)
-        bb1[bb1 < -0.5] = -0.5    
+        bb1[bb1 < -0.5] = -0.5
         bb2 = b2(xx)
         bb2[bb2 > data.shape[0] - 0.5] = data.shape[0] - 0.5
         extract2(data2, xx, bb1, bb2, out[idx])
     return out
+
+
+def polyval_rows(coeffs, x):
+    '''Evaluate each row of coeffs as a polynomial in x.
+
+    The evaluation follows the Horner scheme of numpy.polyval,
+    so the result is identical to evaluating each polynomial
+    separately.
+    '''
+    coeffs = numpy.atleast_2d(coeffs)
+    x = numpy.asarray(x)
+    y = numpy.zeros((coeffs.shape[0], x.shape[0]))
+    for c in coeffs.T:
+        y *= x
+        y += c[:, numpy.newaxis]
+    return y
+
+
+def _borders(lower, upper, nrows, ncols):
+    xx = numpy.arange(ncols)
+
+    bb1 = polyval_rows(lower, xx)
+    bb1[bb1 < -0.5] = -0.5
+    bb2 = polyval_rows(upper, xx)
+    bb2[bb2 > nrows - 0.5] = nrows - 0.5
+    return bb1, bb2
+
+
+def _weights_key(lower, upper, shape):
+    key = hashlib.sha1()
+    key.update(repr((lower.shape, upper.shape, shape)).encode('ascii'))
+    key.update(numpy.ascontiguousarray(lower, dtype='float64'))
+    key.update(numpy.ascontiguousarray(upper, dtype='float64'))
+    return key.hexdigest()
+
+
+def extraction_weights(lower, upper, shape, cache=True):
+    '''Border pixels and weights of the apertures.
+
+    The apertures are extracted from images with the given shape.
+    The weights are kept in a cache, keyed by a hash of the
+    border coefficients and the shape, so that the frames reduced
+    with the same trace map reuse them. The returned arrays are
+    shared and read-only.
+
+    :return: a tuple with the lower and upper border pixels
+        and their weights, each with shape (apertures, columns)
+    '''
+    lower = numpy.atleast_2d(lower)
+    upper = numpy.atleast_2d(upper)
+    nrows, ncols = shape
+
+    if cache:
+        key = _weights_key(lower, upper, shape)
+        with _weights_lock:
+            weights = _weights_cache.pop(key, None)
+            if weights is not None:
+                _weights_cache[key] = weights
+                return weights
+
+    bb1, bb2 = _borders(lower, upper, nrows, ncols)
+    weights = aperture_weights(nrows, bb1, bb2)
+    for arr in weights:
+        arr.flags.writeable = False
+
+    if cache:
+        with _weights_lock:
+            _weights_cache[key] = weights
+            while len(_weights_cache) > _WEIGHTS_CACHE_SIZE:
+                _weights_cache.popitem(last=False)
+
+    return weights
+
+
+def superex_batch(data, lower, upper, out=None, nthreads=1, cache=True):
+    '''Extract all the apertures at once.
+
+    lower and upper are arrays of polynomial coefficients, one row per
+    aperture, highest degree first, with the lower and upper borders of
+    each aperture. The result is the same as :func:`superex` with the
+    corresponding poly1d borders.
+
+    With cache, the weights of the apertures are computed once
+    and reused, see :func:`extraction_weights`. Without cache, the
+    weights are computed on the fly.
+
+    With nthreads > 1, the apertures are split in contiguous blocks,
+    extracted in parallel. Each aperture is computed by one thread only,
+    so the result does not depend on the number of threads.
+    '''
+
+    if nthreads < 1:
+        raise ValueError('nthreads must be positive')
+
+    if data.dtype.byteorder != '=':
+        data2 = data.astype(data.dtype.newbyteorder('='))
+    else:
+        data2 = data
+
+    lower = numpy.atleast_2d(lower)
+    upper = numpy.atleast_2d(upper)
+    naper = len(lower)
+
+    if out is None:
+        out = numpy.zeros((naper, data.shape[1]), dtype='float')
+
+    if cache:
+        pa, pb, wa, wb = extraction_weights(lower, upper, data2.shape)
+
+        def extract_block(region):
+            extract_weights(data2, pa[region], pb[region],
+                            wa[region], wb[region], out[region])
+    else:
+        def extract_block(region):
+            bb1, bb2 = _borders(lower[region], upper[region],
+                                data2.shape[0], data2.shape[1])
+            extract_all(data2, bb1, bb2, out[region])
+
+    run_blocks(extract_block, naper, nthreads)
+
+    return out
+
+
+def superex_stack(stack, lower, upper, out=None, nthreads=1):
+    '''Extract all the apertures of a stack of frames.
+
+    stack has shape (frames, rows, columns) and can be memory mapped.
+    The borders are the same for all the frames, as in
+    :func:`superex_batch`. The weights of the apertures are computed
+    once, the result has shape (frames, apertures, columns).
+    '''
+
+    if nthreads < 1:
+        raise ValueError('nthreads must be positive')
+
+    lower = numpy.atleast_2d(lower)
+    upper = numpy.atleast_2d(upper)
+    naper = len(lower)
+    nframes = stack.shape[0]
+
+    if out is None:
+        out = numpy.zeros((nframes, naper, stack.shape[2]), dtype='float')
+
+    if stack.dtype.byteorder != '=':
+        # convert the frames one by one, to avoid a copy of the stack
+        for frame, rss in zip(stack, out):
+            superex_batch(frame, lower, upper, out=rss, nthreads=nthreads)
+        return out
+
+    pa, pb, wa, wb = extraction_weights(lower, upper, stack.shape[1:])
+
+    def extract_block(region):
+        extract_stack(stack, pa[region], pb[region],
+                      wa[region], wb[region], out[:, region])
+
+    run_blocks(extract_block, naper, nthreads)
+
+    return out
@@ -1,9 +1,12 @@
 
+import cython
+cimport cython
+
 from libc.math cimport floor
 import numpy
 cimport numpy
 
-cdef int wc_to_pix2(double x):
+cdef inline int wc_to_pix2(double x) nogil:
     return <int>(floor(x + 0.5))
 
 ctypedef fused FType:
@@ -17,38 +20,228 @@ ctypedef fused IType:
     long
 
 
-cdef inline int int_max(int a, int b): return a if a >= b else b
-cdef inline int int_min(int a, int b): return a if a <= b else b
+cdef inline int int_max(int a, int b) nogil: return a if a >= b else b
+cdef inline int int_min(int a, int b) nogil: return a if a <= b else b
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline double _sum_column(const FType* col, Py_ssize_t stride, int nrows,
+                               int pa, int pb, double wa, double wb,
+                               double prev) nogil:
+    '''Sum the column between the pixels pa and pb.
+
+    col points to the first row of the column and stride is the
+    distance in bytes between rows. The pixels pa and pb are weighted
+    with wa and wb. prev is returned if the aperture is outside the column.
+    '''
+    cdef int c
+    cdef double acc
+
+    if pa == pb:
+        if pa >= 0 and pa < nrows:
+            return (<const FType*>(<const char*>col + pa * stride))[0] * wa
+        return prev
+    else:
+        acc = 0
+        if pa >= 0 and pa < nrows:
+            acc += (<const FType*>(<const char*>col + pa * stride))[0] * wa
+
+        if pb < nrows and pb >= 0:
+            acc += (<const FType*>(<const char*>col + pb * stride))[0] * wb
+        for c in range(pa + 1, pb):
+            acc += (<const FType*>(<const char*>col + c * stride))[0]
+        return acc
+
+
+cdef inline void _column_weights(int nrows, double a, double b,
+                                 int* pa, int* pb, double* wa, double* wb) nogil:
+    '''Compute the border pixels and weights between a and b.'''
+    pb[0] = int_min(wc_to_pix2(b), nrows)
+    pa[0] = int_max(0, wc_to_pix2(a))
+    if pa[0] == pb[0]:
+        wa[0] = b - a
+        wb[0] = 0
+    else:
+        wa[0] = pa[0] + 0.5 - a
+        wb[0] = b - (pb[0] -0.5)
+
+
+cdef inline double _extract_column(const FType* col, Py_ssize_t stride,
+                                   int nrows, double a, double b,
+                                   double prev) nogil:
+    '''Sum the column between the borders a and b.'''
+    cdef int pa, pb
+    cdef double wa, wb
+
+    _column_weights(nrows, a, b, &pa, &pb, &wa, &wb)
+    return _sum_column(col, stride, nrows, pa, pb, wa, wb, prev)
+
 
-def extract2(FType[:,:] data, IType[:] xx, double[:] bb1, double[:] bb2, double[:] out):
+def extract2(const FType[:,:] data, IType[:] xx, double[:] bb1, double[:] bb2, double[:] out):
 
     cdef size_t size = xx.shape[0]
     cdef size_t i
-    cdef int pa, pb
-    cdef IType x
-    cdef double a,b,w,acc
-    
+    cdef Py_ssize_t x
+    cdef int nrows = data.shape[0]
+    cdef Py_ssize_t stride = data.strides[0]
+
+    if nrows == 0:
+        return out
+
     for i in range(size):
         x = xx[i]
-        a = bb1[i]
-        b = bb2[i]
-        pb = int_min(wc_to_pix2(b), data.shape[0])
-        pa = int_max(0, wc_to_pix2(a))    
-        if pa == pb:
-            if pa >= 0 and pa < data.shape[0]:
-                w = b - a
-                out[x] = data[pa, x] * w
-        else:
-            acc = 0
-            if pa >= 0 and pa < data.shape[0]:
-                w = pa + 0.5 - a
-                acc += data[pa, x] * w
-            
-            if pb < data.shape[1] and pb >= 0:
-                w = b - (pb -0.5)
-                acc += data[pb, x] * w
-            for c in range(pa + 1, pb):
-                acc += data[c,x]
-            out[x] = acc
+        out[x] = _extract_column(&data[0, x], stride, nrows,
+                                 bb1[i], bb2[i], out[x])
     return out
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extract_all(const FType[:,:] data, double[:,:] bb1, double[:,:] bb2, double[:,:] out):
+    '''Extract all the apertures, with borders bb1 and bb2 in each column.
+
+    Each row of bb1 and bb2 contains the borders of one aperture,
+    evaluated in all the columns of data. The loop runs without the GIL.
+    '''
+
+    cdef size_t naper = bb1.shape[0]
+    cdef size_t ncols = bb1.shape[1]
+    cdef size_t i, x
+    cdef int nrows = data.shape[0]
+    cdef Py_ssize_t stride = data.strides[0]
+
+    if bb2.shape[0] != naper or out.shape[0] < naper:
+        raise ValueError('number of apertures does not match')
+
+    if bb2.shape[1] != ncols or out.shape[1] != ncols or data.shape[1] != ncols:
+        raise ValueError('number of columns does not match')
+
+    if nrows == 0:
+        return out
+
+    with nogil:
+        for i in range(naper):
+            for x in range(ncols):
+                out[i, x] = _extract_column(&data[0, x], stride, nrows,
+                                            bb1[i, x], bb2[i, x], out[i, x])
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def aperture_weights(int nrows, double[:,:] bb1, double[:,:] bb2):
+    '''Compute the border pixels and weights of all the apertures.
+
+    Returns the arrays of lower and upper border pixels and
+    their weights, with the same shape of bb1. The weights
+    can be used with extract_weights in images with nrows rows.
+    '''
+
+    cdef size_t naper = bb1.shape[0]
+    cdef size_t ncols = bb1.shape[1]
+    cdef size_t i, x
+
+    if bb2.shape[0] != naper or bb2.shape[1] != ncols:
+        raise ValueError('shape of borders does not match')
+
+    pa = numpy.empty((naper, ncols), dtype='int32')
+    pb = numpy.empty((naper, ncols), dtype='int32')
+    wa = numpy.empty((naper, ncols), dtype='float64')
+    wb = numpy.empty((naper, ncols), dtype='float64')
+
+    cdef int[:,:] pa_v = pa
+    cdef int[:,:] pb_v = pb
+    cdef double[:,:] wa_v = wa
+    cdef double[:,:] wb_v = wb
+
+    with nogil:
+        for i in range(naper):
+            for x in range(ncols):
+                _column_weights(nrows, bb1[i, x], bb2[i, x],
+                                &pa_v[i, x], &pb_v[i, x],
+                                &wa_v[i, x], &wb_v[i, x])
+    return pa, pb, wa, wb
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extract_weights(const FType[:,:] data, const int[:,:] pa,
+                    const int[:,:] pb, const double[:,:] wa,
+                    const double[:,:] wb, double[:,:] out):
+    '''Extract all the apertures, using precomputed weights.
+
+    The border pixels and weights are computed with aperture_weights.
+    The loop runs without the GIL.
+    '''
+
+    cdef size_t naper = pa.shape[0]
+    cdef size_t ncols = pa.shape[1]
+    cdef size_t i, x
+    cdef int nrows = data.shape[0]
+    cdef Py_ssize_t stride = data.strides[0]
+
+    if (pb.shape[0] != naper or wa.shape[0] != naper or
+            wb.shape[0] != naper or out.shape[0] < naper):
+        raise ValueError('number of apertures does not match')
+
+    if (pb.shape[1] != ncols or wa.shape[1] != ncols or
+            wb.shape[1] != ncols or out.shape[1] != ncols or
+            data.shape[1] != ncols):
+        raise ValueError('number of columns does not match')
+
+    if nrows == 0:
+        return out
+
+    with nogil:
+        for i in range(naper):
+            for x in range(ncols):
+                out[i, x] = _sum_column(&data[0, x], stride, nrows,
+                                        pa[i, x], pb[i, x],
+                                        wa[i, x], wb[i, x], out[i, x])
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extract_stack(const FType[:,:,:] data, const int[:,:] pa,
+                  const int[:,:] pb, const double[:,:] wa,
+                  const double[:,:] wb, double[:,:,:] out):
+    '''Extract all the apertures of a stack of frames.
+
+    The border pixels and weights are computed with aperture_weights.
+    The weights of each aperture are read once and applied to all the
+    frames. The loop runs without the GIL.
+    '''
+
+    cdef size_t nframes = data.shape[0]
+    cdef size_t naper = pa.shape[0]
+    cdef size_t ncols = pa.shape[1]
+    cdef size_t i, k, x
+    cdef int nrows = data.shape[1]
+    cdef Py_ssize_t stride = data.strides[1]
+
+    if out.shape[0] != nframes:
+        raise ValueError('number of frames does not match')
+
+    if (pb.shape[0] != naper or wa.shape[0] != naper or
+            wb.shape[0] != naper or out.shape[1] < naper):
+        raise ValueError('number of apertures does not match')
+
+    if (pb.shape[1] != ncols or wa.shape[1] != ncols or
+            wb.shape[1] != ncols or out.shape[2] != ncols or
+            data.shape[2] != ncols):
+        raise ValueError('number of columns does not match')
+
+    if nrows == 0:
+        return out
+
+    with nogil:
+        for i in range(naper):
+            for k in range(nframes):
+                for x in range(ncols):
+                    out[k, i, x] = _sum_column(&data[k, 0, x], stride, nrows,
+                                               pa[i, x], pb[i, x],
+                                               wa[i, x], wb[i, x],
+                                               out[k, i, x])
+    return out
@@ -20,27 +20,43 @@
 '''Peak finding for Megara'''
 
 import numpy as np
-from scipy.ndimage.filters import generic_filter
+from numpy.lib.stride_tricks import as_strided
+
+from ._peakdetection import peakdet_index, peakdet_index_batch
+
+
+def _windows(k, data):
+    '''Sliding windows of 2*k+1 points, one per point of data.
+
+    data is reflected at the borders, as in the 'reflect' mode
+    of scipy.ndimage filters.
+    '''
+    data = np.asarray(data, dtype='float64')
+    padded = np.pad(data, k, mode='symmetric')
+    size = 2 * k + 1
+    windows = as_strided(padded, shape=(len(data), size),
+                         strides=(padded.strides[0], padded.strides[0]))
+    return np.ascontiguousarray(windows)
 
 
 def _vecS1(k, data):
     '''max filter for peak detection.'''
 
-    def func(x):
-        return x[k] - 0.5 * (x[:k].max() + x[k+1:].max())
-
-    ap = generic_filter(data, func, size=2*k+1)
-    return ap
+    windows = _windows(k, data)
+    ap = windows[:, k] - 0.5 * (windows[:, :k].max(axis=1) +
+                                windows[:, k+1:].max(axis=1))
+    # same output type of generic_filter
+    return ap.astype(np.asarray(data).dtype)
 
 
 def _vecS2(k, data):
     '''min filter for peak detection.'''
 
-    def func(x):
-        return x[k] - 0.5 * (x[:k].mean() + x[k+1:].mean())
-
-    ap = generic_filter(data, func, size=2*k+1)
-    return ap
+    windows = _windows(k, data)
+    ap = windows[:, k] - 0.5 * (windows[:, :k].mean(axis=1) +
+                                windows[:, k+1:].mean(axis=1))
+    # same output type of generic_filter
+    return ap.astype(np.asarray(data).dtype)
 
 
 # http://tcs-trddc.com/trddc_website/pdf/srl/palshikar_sapdts_2009.pdf
@@ -57,7 +73,6 @@ def _generic_peak_filtering(method, y, x=None, k=3, h=1.0, background=0.0,
     if xmax is None:
         xmax = x[-1]
 
-    candidates = []
     # Fixme...
 
     ap = method(k, y)
@@ -68,29 +83,37 @@ def _generic_peak_filtering(method, y, x=None, k=3, h=1.0, background=0.0,
     # mpos = appos.mean()
     # spos = appos.std()
 
-    for idx, a in enumerate(ap):
-        if a > 0 and y[idx] > background and (xmin <= x[idx] <= xmax):
-            candidates.append(idx)
+    y = np.asarray(y)
+    x = np.asarray(x)
+    mask = (ap > 0) & (y > background) & (x >= xmin) & (x <= xmax)
+    candidates = np.flatnonzero(mask)
 
     # Filter close elements
-    result = []
-    while len(candidates) > 1:
-
-        x0 = candidates[0]
-        for idx, xi in enumerate(candidates[1:], 1):
-            if abs(xi - x0) > k:
-                break
-
-        group = candidates[:idx]
-
-        remaining = candidates[idx:]
-        maxvalid = y[group].argmax()
-        finalid = group[maxvalid]
-        result.append((finalid, x[finalid], y[finalid]))
-
-        candidates = remaining
-
-    return np.array(result)
+    # Each group starts in a candidate and contains the following
+    # candidates at a distance <= k of the first. The last candidate
+    # is never the start of a group
+    ncand = len(candidates)
+    starts = []
+    first = 0
+    while first < ncand - 1:
+        starts.append(first)
+        nxt = np.searchsorted(candidates, candidates[first] + k, side='right')
+        first = min(nxt, ncand - 1)
+
+    if not starts:
+        return np.array([])
+
+    # the candidates after the last group are dropped
+    stop = first
+    groups = candidates[:stop]
+    yg = y[groups]
+    gid = np.repeat(np.arange(len(starts)), np.diff(starts + [stop]))
+    # first maximum of each group
+    ymax = np.maximum.reduceat(yg, starts)
+    pos = np.where(yg == ymax[gid], np.arange(stop), stop)
+    finalid = groups[np.minimum.reduceat(pos, starts)]
+
+    return np.column_stack([finalid, x[finalid], y[finalid]])
 
 
 def peak_detection_mean_window(y, x=None, k=3, h=1.0, background=0.0,
@@ -116,13 +139,7 @@ def peak_detection_max_window(y, x=None, k=3, h=1.0, background=0.0,
                                    background=background, xmin=xmin, xmax=xmax)
 
 
-def peakdet(v, delta, x=None, back=0.0):
-    '''Basic peak detection.'''
-
-    if x is None:
-        x = np.arange(len(v))
-
-    v = np.asarray(v)
+def _check_peakdet(v, delta, x):
 
     if len(v) != len(x):
         raise ValueError('Input vectors v and x must have same length')
@@ -133,82 +150,139 @@ def peakdet(v, delta, x=None, back=0.0):
     if delta <= 0:
         raise ValueError('Input argument delta must be positive')
 
-    maxtab = []
-    mintab = []
 
-    mn, mx = np.Inf, -np.Inf
-    mnpos, mxpos = np.NaN, np.NaN
+def _peak_table(x, v, idx):
+    if len(idx) == 0:
+        return np.array([])
+    return np.column_stack([x[idx], v[idx]])
 
-    lookformax = True
 
-    for i, this in enumerate(v):
-        if this > mx and this > back:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
+def peakdet(v, delta, x=None, back=0.0):
+    '''Basic peak detection.'''
 
-        if lookformax:
-            if this < mx - delta and this > back:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
-        else:
-            if this > mn + delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
+    v = np.asarray(v)
 
-    return np.array(maxtab), np.array(mintab)
+    if x is None:
+        x = np.arange(len(v))
+
+    x = np.asarray(x)
+
+    _check_peakdet(v, delta, x)
+
+    imax, imin = peakdet_index(v.astype('float64'), delta, back)
+
+    return _peak_table(x, v, imax), _peak_table(x, v, imin)
 
 
 def peak_detection_basic(v, delta, x=None, back=0.0):
     '''Basic peak detection.'''
 
+    return peakdet(v, delta, x=x, back=back)[0]
+
+
+def peakdet_batch(v, delta, x=None, back=0.0):
+    '''Basic peak detection in each row of v.
+
+    Returns a list with the maximum and minimum tables of each row,
+    the same as peakdet applied to each row.
+    '''
+
+    v = np.atleast_2d(v)
+
     if x is None:
-        x = np.arange(len(v))
+        x = np.arange(v.shape[1])
 
-    v = np.asarray(v)
+    x = np.asarray(x)
 
-    if len(v) != len(x):
-        raise ValueError('Input vectors v and x must have same length')
+    _check_peakdet(v[0], delta, x)
 
-    if not np.isscalar(delta):
-        raise TypeError('Input argument delta must be a scalar')
+    imax, maxoff, imin, minoff = peakdet_index_batch(v.astype('float64'),
+                                                     delta, back)
+    result = []
+    for row, l1, l2, m1, m2 in zip(v, maxoff[:-1], maxoff[1:],
+                                   minoff[:-1], minoff[1:]):
+        result.append((_peak_table(x, row, imax[l1:l2]),
+                       _peak_table(x, row, imin[m1:m2])))
+    return result
 
-    if delta <= 0:
-        raise ValueError('Input argument delta must be positive')
 
-    maxtab = []
-    mintab = []
+def refine_peaks(y, pixmax, x=None, npoints=5, method='parabola',
+                 columns=None):
+    '''Refine the position of peaks to sub-pixel precision.
 
-    mn, mx = np.Inf, -np.Inf
-    mnpos, mxpos = np.NaN, np.NaN
+    All the peaks are refined at once, using the npoints (3 or 5)
+    points around each peak and closed-form expressions for equally
+    spaced samples. The methods are:
 
-    lookformax = True
+    * parabola: the vertex of the least squares parabola, the same
+      as fitting a second degree polynomial to each peak
+    * gaussian: the same fit, to the logarithm of the values; the
+      points must be positive
+    * barycentre: the mean position weighted with the values, the
+      value of the peak is the central point
 
-    for i, this in enumerate(v):
-        if this > mx and this > back:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
+    y can be a profile or a 2D image. In the latter case, the peak
+    i is in the column columns[i] and pixmax indexes the rows.
 
-        if lookformax:
-            if this < mx - delta and this > back:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
-        else:
-            if this > mn + delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
+    x must be equally spaced.
+
+    :return: the refined position and value of each peak, and a mask
+        with the peaks that could be refined; the position and value
+        of the other peaks are not valid
+    '''
 
-    return np.array(maxtab)
+    y = np.asarray(y)
+    pixmax = np.asarray(pixmax, dtype='int')
+    size = y.shape[0]
+
+    if x is None:
+        x = np.arange(size)
+
+    if npoints not in (3, 5):
+        raise ValueError('npoints must be 3 or 5')
+
+    if method not in ('parabola', 'gaussian', 'barycentre'):
+        raise ValueError('method must be parabola, gaussian or barycentre')
+
+    half = npoints // 2
+    valid = (pixmax >= half) & (pixmax < size - half)
+    if size < npoints:
+        nan = np.full(pixmax.shape, np.nan)
+        return nan, nan.copy(), valid
+
+    idx = np.where(valid, pixmax, half)
+    offsets = np.arange(-half, half + 1)
+    if y.ndim == 1:
+        yy = y[idx + offsets[:, np.newaxis]]
+    else:
+        yy = y[idx + offsets[:, np.newaxis], columns]
+    yy = yy.astype('float64')
+
+    if method == 'gaussian':
+        valid = valid & np.all(yy > 0, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            yy = np.log(yy)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'barycentre':
+            tt = (offsets[:, np.newaxis] * yy).sum(axis=0) / yy.sum(axis=0)
+            val = yy[half]
+        else:
+            if npoints == 3:
+                aa = 0.5 * (yy[0] + yy[2] - 2 * yy[1])
+                bb = 0.5 * (yy[2] - yy[0])
+                cc = yy[1]
+            else:
+                aa = (2 * yy[0] - yy[1] - 2 * yy[2] - yy[3] +
+                      2 * yy[4]) / 14.0
+                bb = (-2 * yy[0] - yy[1] + yy[3] + 2 * yy[4]) / 10.0
+                cc = (-3 * yy[0] + 12 * yy[1] + 17 * yy[2] +
+                      12 * yy[3] - 3 * yy[4]) / 35.0
+            tt = -bb / (2 * aa)
+            val = cc - bb * bb / (4 * aa)
+            if method == 'gaussian':
+                val = np.exp(val)
+
+    delta = x[1] - x[0] if len(x) > 1 else 1
+    pos = x[idx] + tt * delta
+    return pos, val, valid
@@ -0,0 +1,115 @@
+#
+# Copyright 2015 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# Megara DRP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Megara DRP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Megara DRP.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import cython
+cimport cython
+
+import numpy
+
+from libc.math cimport INFINITY
+from libcpp.vector cimport vector
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _peakdet(const double[:] v, double delta, double back,
+                   vector[Py_ssize_t]& maxtab,
+                   vector[Py_ssize_t]& mintab) nogil:
+    '''Find the indices of the maxima and minima of v.'''
+
+    cdef Py_ssize_t i
+    cdef Py_ssize_t mnpos = -1
+    cdef Py_ssize_t mxpos = -1
+    cdef double this
+    cdef double mn = INFINITY
+    cdef double mx = -INFINITY
+    cdef bint lookformax = True
+
+    for i in range(v.shape[0]):
+        this = v[i]
+        if this > mx and this > back:
+            mx = this
+            mxpos = i
+        if this < mn:
+            mn = this
+            mnpos = i
+
+        if lookformax:
+            if this < mx - delta and this > back:
+                maxtab.push_back(mxpos)
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this > mn + delta:
+                mintab.push_back(mnpos)
+                mx = this
+                mxpos = i
+                lookformax = True
+
+
+def _to_array(vector[Py_ssize_t]& vec):
+    cdef size_t i
+    result = numpy.empty((vec.size(),), dtype='intp')
+    for i in range(vec.size()):
+        result[i] = vec[i]
+    return result
+
+
+def peakdet_index(const double[:] v, double delta, double back=0.0):
+    '''Basic peak detection, returning indices.
+
+    Returns the indices of the maxima and of the minima of v.
+    The detection runs without the GIL.
+    '''
+    cdef vector[Py_ssize_t] maxtab
+    cdef vector[Py_ssize_t] mintab
+
+    with nogil:
+        _peakdet(v, delta, back, maxtab, mintab)
+
+    return _to_array(maxtab), _to_array(mintab)
+
+
+def peakdet_index_batch(const double[:, :] v, double delta, double back=0.0):
+    '''Basic peak detection in each row of v, returning indices.
+
+    Returns ragged arrays with the indices of the maxima and of the
+    minima of all the rows, and their offsets: the maxima of the
+    row i are maxidx[maxoff[i]:maxoff[i + 1]].
+    The detection runs without the GIL.
+    '''
+    cdef size_t nrows = v.shape[0]
+    cdef size_t i
+    cdef vector[Py_ssize_t] maxtab
+    cdef vector[Py_ssize_t] mintab
+    cdef vector[Py_ssize_t] maxoff
+    cdef vector[Py_ssize_t] minoff
+
+    with nogil:
+        for i in range(nrows):
+            maxoff.push_back(maxtab.size())
+            minoff.push_back(mintab.size())
+            _peakdet(v[i], delta, back, maxtab, mintab)
+        maxoff.push_back(maxtab.size())
+        minoff.push_back(mintab.size())
+
+    return (_to_array(maxtab), _to_array(maxoff),
+            _to_array(mintab), _to_array(minoff))
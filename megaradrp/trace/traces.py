@@ -20,8 +20,12 @@
 from __future__ import division, print_function
 
 import numpy as np
+from scipy.special import comb
 
-from .peakdetection import peak_detection_mean_window
+from .peakdetection import peak_detection_mean_window, refine_peaks
+from ._traces import tracing_many, tracing_global
+from .extract import polyval_rows
+from megaradrp.parallel import run_blocks
 
 def delicate_centre(x, y):
     pos = np.polyfit(x, y, deg=2)
@@ -66,15 +70,261 @@ def init_traces(image, center, hs, background, npred, maxdis=9.0):
 
     fw = 2
 
-    for fibid, trace in fiber_traces.items():
-        _xi, _yi, _vali = center, maxt[fibid,1], maxt[fibid,2]
-        pixmax = int(maxt[fibid,0])
-        # Take 2*2+1 pix
-        # This part and interp_max_3(image[nearp3-1:nearp3+2, col])
-        # should do the same
-        tx, py, _pos = delicate_centre(xx[pixmax-fw: pixmax+fw+1], 
-                                     colcut[pixmax-fw: pixmax+fw+1])
+    fibids = list(fiber_traces.keys())
+    pixmax = maxt[fibids, 0].astype('int')
+    # Take 2*2+1 pix
+    # This part and interp_max_3(image[nearp3-1:nearp3+2, col])
+    # should do the same
+    tx, py, valid = refine_peaks(colcut, pixmax, x=xx, npoints=2 * fw + 1)
 
-        trace.start = (center, tx, py)
+    for fibid, ptx, ppy, pvalid, pix in zip(fibids, tx, py, valid, pixmax):
+        if not pvalid:
+            # peaks near the border
+            ptx, ppy, _pos = delicate_centre(xx[pix-fw: pix+fw+1],
+                                             colcut[pix-fw: pix+fw+1])
+        fiber_traces[fibid].start = (center, ptx, ppy)
 
     return fiber_traces
+
+
+def trace_all(image, starts, step=1, hs=1, tol=2, background=150.0,
+              maxdis=2.0, nthreads=1):
+    '''Trace all the peaks starting in starts.
+
+    starts is a sequence of (x, y, p) starting points. The traces are
+    split in nthreads blocks, traced concurrently. The points of the
+    traces are returned as a ragged array: an array of points with
+    shape (npoints, 3) and the offsets of the traces, the points of the
+    trace i are points[offsets[i]:offsets[i + 1]].
+    '''
+
+    if image.dtype.byteorder != '=':
+        image = image.astype(image.dtype.newbyteorder('='))
+
+    starts = np.asarray(starts, dtype='float').reshape(-1, 3)
+    x, y, p = [np.ascontiguousarray(c) for c in starts.T]
+    ntraces = len(starts)
+
+    blocks = {}
+
+    def trace_block(region):
+        blocks[region.start] = tracing_many(image, x[region], y[region],
+                                            p[region], step=step, hs=hs,
+                                            tol=tol, background=background,
+                                            maxdis=maxdis)
+
+    run_blocks(trace_block, ntraces, nthreads)
+
+    points = []
+    offsets = [np.zeros((1,), dtype='intp')]
+    base = 0
+    for key in sorted(blocks):
+        bpoints, boffsets = blocks[key]
+        points.append(bpoints)
+        offsets.append(boffsets[1:] + base)
+        base += len(bpoints)
+
+    if not points:
+        return np.empty((0, 3)), offsets[0]
+
+    return np.concatenate(points), np.concatenate(offsets)
+
+
+def trace_global(image, starts, step=1, hs=1, tol=2, background=150.0,
+                 maxdis=2.0):
+    '''Trace all the peaks starting in starts together.
+
+    All the traces start in the same column and advance together, column
+    by column. Each column is collapsed once and its peaks are assigned
+    to the nearest predicted traces, each peak to one trace only. The
+    prediction, tol and maxdis work as in the tracing of each fiber, so
+    the traces are the same unless two of them reach the same peak.
+    The result has the same layout as :func:`trace_all`.
+    '''
+
+    if image.dtype.byteorder != '=':
+        image = image.astype(image.dtype.newbyteorder('='))
+
+    starts = np.asarray(starts, dtype='float').reshape(-1, 3)
+    x, y, p = [np.ascontiguousarray(c) for c in starts.T]
+
+    return tracing_global(image, x, y, p, step=step, hs=hs, tol=tol,
+                          background=background, maxdis=maxdis)
+
+
+def polyfit_batch(x, y, offsets, deg):
+    '''Least squares polynomial fit of a ragged set of curves.
+
+    The points of the curve i are x[offsets[i]:offsets[i + 1]], and
+    the same for y. All the fits are solved at once: x is mapped to
+    [-1, 1] in each curve, the normal equations of all the curves are
+    built with segmented sums and solved together, and the coefficients
+    are transformed back to powers of x. The coefficients match
+    numpy.polyfit to rounding. Curves with less than deg + 1 points
+    are fitted with numpy.polyfit.
+
+    :return: an array of coefficients, with shape (curves, deg + 1),
+        highest degree first
+    '''
+
+    x = np.asarray(x, dtype='float')
+    y = np.asarray(y, dtype='float')
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    ncurves = len(counts)
+    order = deg + 1
+
+    if ncurves == 0:
+        return np.empty((0, order))
+
+    starts = offsets[:-1]
+    xmin = np.minimum.reduceat(x, starts)
+    xmax = np.maximum.reduceat(x, starts)
+    center = 0.5 * (xmax + xmin)
+    half = 0.5 * (xmax - xmin)
+    half[half == 0] = 1.0
+
+    idx = np.repeat(np.arange(ncurves), counts)
+    t = (x[offsets[0]:offsets[-1]] - center[idx]) / half[idx]
+    yc = y[offsets[0]:offsets[-1]]
+    starts = starts - offsets[0]
+
+    # moments sum(t**k), k <= 2 * deg, and sum(y * t**k), k <= deg
+    tpow = np.ones_like(t)
+    tmom = np.empty((ncurves, 2 * deg + 1))
+    ymom = np.empty((ncurves, order))
+    for k in range(2 * deg + 1):
+        tmom[:, k] = np.add.reduceat(tpow, starts)
+        if k < order:
+            ymom[:, k] = np.add.reduceat(tpow * yc, starts)
+        tpow = tpow * t
+
+    # normal equations, in increasing powers of t
+    powers = np.add.outer(np.arange(order), np.arange(order))
+    lhs = tmom[:, powers]
+    # short curves are fitted one by one, below
+    short = counts < order
+    lhs[short] = np.identity(order)
+    coeffs_t = np.linalg.solve(lhs, ymom[..., np.newaxis])[..., 0]
+
+    # back to increasing powers of x
+    coeffs = np.zeros_like(coeffs_t)
+    for k in range(order):
+        bk = coeffs_t[:, k] / half ** k
+        for j in range(k + 1):
+            coeffs[:, j] += bk * comb(k, j) * (-center) ** (k - j)
+
+    coeffs = coeffs[:, ::-1]
+    for i in np.flatnonzero(short):
+        region = slice(offsets[i], offsets[i + 1])
+        coeffs[i] = np.polyfit(x[region], y[region], deg)
+
+    return coeffs
+
+
+def column_profiles(image, columns, hs):
+    '''Mean of the columns c - hs to c + hs, for each c in columns.
+
+    :return: an array with shape (rows, len(columns))
+    '''
+    columns = np.asarray(columns, dtype='int')
+    profiles = np.zeros((image.shape[0], len(columns)))
+    for k in range(-hs, hs + 1):
+        profiles += image[:, columns + k]
+    return profiles / (2 * hs + 1)
+
+
+def measure_offsets(image, coeffs, columns, hs=3, maxshift=3.0,
+                    groups=None, sigma=1.0):
+    '''Offset and tilt of the traces with respect to a trace map.
+
+    In each column, the mean profile of the columns around it is
+    cross-correlated with a model made of Gaussian profiles, with width
+    sigma, in the positions predicted by coeffs (one row of polynomial
+    coefficients per trace, highest degree first). The correlation is
+    computed in steps of 0.25 pixels up to maxshift and its maximum
+    refined with a parabola. The shifts of the columns are fitted
+    with a line.
+
+    The traces with the same value in groups share the offset and tilt,
+    all the traces are a group by default.
+
+    :return: the group labels, the offsets (at x = 0) and the tilts
+        of each group
+    '''
+    coeffs = np.atleast_2d(coeffs)
+    columns = np.asarray(columns, dtype='int')
+    if groups is None:
+        groups = np.zeros((len(coeffs),), dtype='int')
+    groups = np.asarray(groups)
+    labels = np.unique(groups)
+
+    profiles = column_profiles(image, columns, hs)
+    nrows = image.shape[0]
+    ypos = polyval_rows(coeffs, columns)
+
+    dlag = 0.25
+    lags = np.arange(-maxshift, maxshift + dlag / 2, dlag)
+    # rows around each trace that contribute to the correlation
+    half = int(np.ceil(maxshift + 4 * sigma))
+    near = np.arange(-half, half + 1)
+
+    shifts = np.empty((len(labels), len(columns)))
+    for j in range(len(columns)):
+        rows = np.floor(ypos[:, j]).astype('int')[:, np.newaxis] + near
+        inside = (rows >= 0) & (rows < nrows)
+        values = np.where(inside, profiles[rows.clip(0, nrows - 1), j], 0.0)
+        # model of each trace, shifted by each lag
+        dist = rows[..., np.newaxis] - ypos[:, j, np.newaxis, np.newaxis]
+        model = np.exp(-0.5 * ((dist - lags) / sigma) ** 2)
+        cc_trace = (values[..., np.newaxis] * model).sum(axis=1)
+        for i, label in enumerate(labels):
+            cc = cc_trace[groups == label].sum(axis=0)
+            imax = min(max(cc.argmax(), 1), len(lags) - 2)
+            c0, c1, c2 = cc[imax - 1:imax + 2]
+            den = c0 + c2 - 2 * c1
+            frac = 0.5 * (c0 - c2) / den if den != 0 else 0.0
+            shifts[i, j] = lags[imax] + frac * dlag
+
+    if len(columns) > 1:
+        tilts, offsets = np.polyfit(columns, shifts.T, 1)
+    else:
+        tilts = np.zeros((len(labels),))
+        offsets = shifts[:, 0]
+
+    return labels, offsets, tilts
+
+
+def trace_residuals(image, coeffs, columns, hs=3):
+    '''Distance of the traces to the peaks of the image.
+
+    In each column, the peak nearest to the position predicted by
+    coeffs is refined with a parabola, using the mean profile of the
+    columns around it, as in the tracing.
+
+    :return: the residuals, with shape (traces, columns), NaN if
+        the peak is not found
+    '''
+    coeffs = np.atleast_2d(coeffs)
+    columns = np.asarray(columns, dtype='int')
+    nrows = image.shape[0]
+
+    profiles = column_profiles(image, columns, hs)
+    ypos = polyval_rows(coeffs, columns)
+
+    # local maximum in the pixels around the prediction
+    cols = np.repeat(np.arange(len(columns))[np.newaxis], len(coeffs), axis=0)
+    pix = np.floor(ypos + 0.5).astype('int').clip(1, nrows - 2)
+    around = np.array([profiles[pix + k, cols] for k in (-1, 0, 1)])
+    pixmax = pix + around.argmax(axis=0) - 1
+
+    tx, _, valid = refine_peaks(profiles, pixmax.ravel(), npoints=3,
+                                columns=cols.ravel())
+    # the refined peak must be a local maximum
+    center = pixmax.clip(1, nrows - 2)
+    ismax = ((profiles[center, cols] >= profiles[center - 1, cols]) &
+             (profiles[center, cols] >= profiles[center + 1, cols]))
+    valid = valid.reshape(ypos.shape) & ismax
+    residuals = tx.reshape(ypos.shape) - ypos
+    residuals[~valid] = np.nan
+    return residuals
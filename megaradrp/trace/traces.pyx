@@ -27,6 +27,7 @@ from libc.math cimport floor, ceil
 from libc.math cimport fabs
 #from libc.stdio cimport printf
 from libcpp.vector cimport vector
+from libc.stdlib cimport malloc, free
 
 ctypedef fused FType:
     double
@@ -43,13 +44,28 @@ cdef extern from "Trace.h" namespace "Numina":
         vector[double] ytrace
         vector[double] ptrace
         void reverse() nogil
+        void reserve(size_t n) nogil
 
 
-cdef vector[int] local_max(double* mm, size_t n, double background) nogil:
-    
-    cdef vector[int] result
+cdef struct Parabola:
+    double A
+    double B
+    double C
+
+
+cdef struct Vertex:
+    double x
+    double y
+
+
+cdef void local_max(double* mm, size_t n, double background,
+                    vector[int]& result) nogil:
+    '''Indices of the local maxima of mm, stored in result.'''
+
     cdef size_t i
-    
+
+    result.clear()
+
     if mm[0] >= background:
         if mm[0] > mm[1]:
             result.push_back(0)
@@ -62,64 +78,70 @@ cdef vector[int] local_max(double* mm, size_t n, double background) nogil:
     if mm[n-1] >= background:
         if mm[n-1] > mm[n-2]:
             result.push_back(n-1)
-            
-    return result
 
-@cython.boundscheck(False)
-cdef vector[double] fit_para_equal_spaced(FType[:] dd) nogil:
-    
-    cdef vector[double] result
-    cdef double A, B, C
-    C = dd[1]
-    B = 0.5 * (dd[2] - dd[0])
-    A = 0.5 * (dd[0] + dd[2] - 2 * dd[1])
+
+cdef inline Parabola fit_para_equal_spaced(FType d0, FType d1, FType d2) nogil:
     
-    result.push_back(A)
-    result.push_back(B)
-    result.push_back(C)
+    cdef Parabola result
+    result.C = d1
+    result.B = 0.5 * (d2 - d0)
+    result.A = 0.5 * (d0 + d2 - 2 * d1)
     return result
 
-@cython.boundscheck(False)
-cdef vector[double] interp_max_3(FType[:] dd) nogil:
+
+cdef inline Vertex interp_max_3(FType d0, FType d1, FType d2) nogil:
     '''Parabola that passes through 3 points
         
     With X=[-1,0,1]
     '''
-    cdef vector[double] result
-    cdef vector[double] params
-    cdef double A,B,C
-    params = fit_para_equal_spaced(dd)
-    A = params[0]
-    B = params[1]
-    C = params[2]
-    result.push_back(-B / (2*A))
-    result.push_back(C - B * B / (4*A))
+    cdef Vertex result
+    cdef Parabola params = fit_para_equal_spaced(d0, d1, d2)
+    result.x = -params.B / (2 * params.A)
+    result.y = params.C - params.B * params.B / (4 * params.A)
     return result
 
+
 cdef int wc_to_pix(double x) nogil:
     return <int>floor(x + 0.5)
 
+
+cdef inline Py_ssize_t slice_index(Py_ssize_t idx, Py_ssize_t size) nogil:
+    '''Index of a slice bound, as in memoryview slicing.'''
+    if idx < 0:
+        idx += size
+        if idx < 0:
+            idx = 0
+    elif idx > size:
+        idx = size
+    return idx
+
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
-cdef int colapse_mean(FType[:, :] arr, vector[double]& out) nogil:
-    cdef size_t I = arr.shape[0]
-    cdef size_t J = arr.shape[1]
+@cython.wraparound(False)
+cdef int colapse_mean(FType[:, :] arr, Py_ssize_t row1, Py_ssize_t row2,
+                      Py_ssize_t col1, Py_ssize_t col2, double* out) nogil:
+    '''Mean of arr[row1:row2, col1:col2] along the columns.'''
+    cdef Py_ssize_t J = col2 - col1
     cdef double accum
-    cdef size_t i, j
-    for i in range(I):
+    cdef Py_ssize_t i, j
+    for i in range(row1, row2):
         accum = 0.0
-        for j in range(J):
+        for j in range(col1, col2):
             accum += arr[i, j]
-        out[i] = accum / J
+        out[i - row1] = accum / J
     
     return 0
 
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
-cdef Trace _internal_tracing(FType[:, :] arr, Trace& trace, double x, double y,
-                             size_t step=1, size_t hs=1, size_t tol=2,
-                             double maxdis=2.0, double background=150.0,
-                             int direction=-1) nogil:
+@cython.wraparound(False)
+cdef void _internal_tracing(FType[:, :] arr, Trace& trace, double x, double y,
+                            vector[double]& pbuff, vector[int]& peaks,
+                            size_t step=1, size_t hs=1, size_t tol=2,
+                            double maxdis=2.0, double background=150.0,
+                            int direction=-1) nogil:
 
     cdef int col = wc_to_pix(x)
     cdef int row = wc_to_pix(y)
@@ -127,52 +149,44 @@ cdef Trace _internal_tracing(FType[:, :] arr, Trace& trace, double x, double y,
     cdef size_t pred_pix
     cdef double prediction
     
-    cdef int axis = 1
     cdef size_t i
     cdef size_t tolcounter = tol
     cdef size_t axis_size = arr.shape[1]
-    cdef const char* aa = "aaaaaa"
+    cdef Py_ssize_t nrows = arr.shape[0]
+    cdef Py_ssize_t row1, row2
     
     # Buffer
     cdef size_t regw = 1 + <int>ceil(maxdis)
     cdef size_t buffsize = 2 * regw + 1
     cdef size_t pred_off 
-    cdef vector[double] pbuff
     # Peaks
-    cdef vector[int] peaks
     cdef double dis, ndis
     cdef size_t ipeak
     cdef size_t nearp    
-    cdef vector[double] result
-    
-    # Init pbuff
-    for _ in range(buffsize):
-        pbuff.push_back(0.0)
-    
-    #print 'Buffer size', buffsize
+    cdef Vertex result
+
+    # Clean the buffer
+    for i in range(buffsize):
+        pbuff[i] = 0.0
     
     while (col - step > hs) and (col + step + hs < axis_size):
-        #print 'we are in column', col
         col += direction * step
-#        printf("--------------------col %i\n", col, prediction)
-        #print 'we go to column', col
-        #print 'we predict the peak will be in coordinate', prediction
         prediction = trace.predict(col)
 
         pred_pix = wc_to_pix(prediction)
         pred_off = pred_pix-regw 
-        #printf("col %i pred %f pix %i\n", col, prediction, pred_pix)
         # extract a region around the expected peak
         # and collapse it
-        colapse_mean(arr[pred_pix-regw:pred_pix+regw + 1,col-hs:col+hs+1], pbuff)
+        row1 = slice_index(<Py_ssize_t>(pred_pix - regw), nrows)
+        row2 = slice_index(<Py_ssize_t>(pred_pix + regw + 1), nrows)
+        colapse_mean(arr, row1, row2, col - hs, col + hs + 1, &pbuff[0])
 
         # Find the peaks
-        peaks = local_max(&pbuff[0], buffsize, background=background)
+        local_max(&pbuff[0], buffsize, background, peaks)
         
         # find nearest peak to prediction
         dis = 40000.0 # a large number
         ipeak = -1
-        #printf("npeaks %i\n", peaks.size())
         for i in range(peaks.size()):
             ndis = fabs(peaks[i] + pred_off - prediction)
             if ndis < dis:
@@ -180,7 +194,6 @@ cdef Trace _internal_tracing(FType[:, :] arr, Trace& trace, double x, double y,
                 ipeak = i
         # check the peak is not further than npixels'
         if ipeak < 0 or dis > maxdis:
-            # printf("peak is not found %i\n", ipeak)
             # peak is not found
             if tolcounter > 0:
                 # Try again
@@ -189,22 +202,250 @@ cdef Trace _internal_tracing(FType[:, :] arr, Trace& trace, double x, double y,
             else:
                 # No more tries
                 # Exit now
-                return trace
+                return
 
         # Reset counter
         tolcounter = tol 
-        #printf("peak %f\n", peaks[ipeak] + pred_off)
-        #printf("col %i pred %f\n", col, prediction)
 
         nearp = peaks[ipeak] + pred_pix - regw
         
-
         # fit the peak with three points
-        result = interp_max_3(arr[nearp-1:nearp+2, col])
+        row1 = slice_index(<Py_ssize_t>(nearp - 1), nrows)
+        result = interp_max_3(arr[row1, col], arr[row1 + 1, col],
+                              arr[row1 + 2, col])
         
-        trace.push_back(col, result[0] + nearp, result[1])
+        trace.push_back(col, result.x + nearp, result.y)
+
+
+cdef void _tracing(FType[:, :] arr, Trace& trace, double x, double y,
+                   double p, vector[double]& pbuff, vector[int]& peaks,
+                   size_t step=1, size_t hs=1, size_t tol=2,
+                   double background=150.0, double maxdis=2.0) nogil:
+
+    cdef size_t regw = 1 + <int>ceil(maxdis)
+    cdef size_t buffsize = 2 * regw + 1
+
+    # Scratch buffers, reused in all the steps
+    pbuff.resize(buffsize, 0.0)
+    peaks.reserve(buffsize)
+    trace.reserve(arr.shape[1] // step + 2)
+
+    # Initial values
+    trace.push_back(x, y, p)
+
+    _internal_tracing(arr, trace, x, y, pbuff, peaks, step=step, hs=hs,
+                      tol=tol, maxdis=maxdis, background=background,
+                      direction=-1)
+    trace.reverse()
+    _internal_tracing(arr, trace, x, y, pbuff, peaks, step=step, hs=hs,
+                      tol=tol, maxdis=maxdis, background=background,
+                      direction=+1)
+
+
+cdef size_t nearest_peak(vector[int]& peaks, double prediction,
+                         size_t hint, double* dis) nogil:
+    '''Index of the peak nearest to prediction, the lower in the ties.
+
+    The search starts in hint, the result of the previous search,
+    the traces are visited in order, so the search is short.
+    There must be at least one peak.
+    '''
+    cdef size_t pos = hint
+    cdef size_t npeaks = peaks.size()
+    cdef double dlow, dup
+
+    if pos > npeaks:
+        pos = npeaks
+
+    # first peak not below the prediction
+    while pos < npeaks and peaks[pos] < prediction:
+        pos += 1
+    while pos > 0 and not (peaks[pos - 1] < prediction):
+        pos -= 1
+
+    if pos == npeaks:
+        dis[0] = fabs(peaks[pos - 1] - prediction)
+        return pos - 1
+
+    dup = fabs(peaks[pos] - prediction)
+    if pos > 0:
+        dlow = fabs(peaks[pos - 1] - prediction)
+        if dlow <= dup:
+            dis[0] = dlow
+            return pos - 1
+    dis[0] = dup
+    return pos
+
+
+# Number of columns collapsed at once in the global tracing
+cdef enum:
+    BLOCK = 64
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void colapse_block(FType[:, :] arr, Py_ssize_t* cols, Py_ssize_t ncols,
+                        Py_ssize_t hs, double* out, FType* raw) nogil:
+    '''Mean of arr[:, col-hs:col+hs+1] along the columns, for each col.
+
+    The image is read by rows. The result has shape (rows, BLOCK),
+    the values of arr in the columns are copied to raw, with the
+    same shape.
+    '''
+    cdef Py_ssize_t J = 2 * hs + 1
+    cdef double accum
+    cdef Py_ssize_t i, j, k
+    for i in range(arr.shape[0]):
+        for k in range(ncols):
+            accum = 0.0
+            for j in range(cols[k] - hs, cols[k] + hs + 1):
+                accum += arr[i, j]
+            out[i * BLOCK + k] = accum / J
+            raw[i * BLOCK + k] = arr[i, cols[k]]
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _tracing_global(FType[:, :] arr, vector[Trace]& traces,
+                          Py_ssize_t step, Py_ssize_t hs, size_t tol,
+                          double background, double maxdis,
+                          double* profiles, FType* raw) nogil:
+    '''Trace all the traces together.
+
+    profiles and raw are buffers with room for rows * BLOCK values.
+    '''
+
+    cdef size_t ntraces = traces.size()
+    cdef Py_ssize_t nrows = arr.shape[0]
+    cdef Py_ssize_t ncols = arr.shape[1]
+    cdef Py_ssize_t start = wc_to_pix(traces[0].xtrace[0])
+    cdef Py_ssize_t col, row, nblock
+    cdef size_t i, b, m, nactive, hint
+    cdef int direction, k
+    cdef double prediction, val
+    cdef Vertex result
+
+    cdef vector[Py_ssize_t] cols
+    cdef vector[vector[int]] peaks
+    cdef vector[int] tolcounter
+    cdef vector[int] nearest
+    cdef vector[double] dis
+    cdef vector[int] owner
+
+    peaks.resize(BLOCK)
+    owner.resize(nrows)
+    tolcounter.resize(ntraces)
+    nearest.resize(ntraces)
+    dis.resize(ntraces)
+
+    for i in range(ntraces):
+        traces[i].reserve(ncols // step + 2)
+
+    for direction in range(-1, 2, 2):
+        if direction == 1:
+            for i in range(ntraces):
+                traces[i].reverse()
+
+        # the columns visited in this direction
+        cols.clear()
+        col = start
+        while (col - step > hs) and (col + step + hs < ncols):
+            col += direction * step
+            cols.push_back(col)
+
+        # tolcounter is -1 in the lost traces
+        for i in range(ntraces):
+            tolcounter[i] = tol
+        nactive = ntraces
+
+        b = 0
+        while b < cols.size() and nactive > 0:
+            # collapse the columns of the block and find all the peaks
+            nblock = min(BLOCK, cols.size() - b)
+            colapse_block(arr, &cols[b], nblock, hs, profiles, raw)
+            for m in range(nblock):
+                peaks[m].clear()
+            for row in range(1, nrows - 1):
+                for m in range(nblock):
+                    val = profiles[row * BLOCK + m]
+                    if val >= background:
+                        if (val > profiles[(row + 1) * BLOCK + m] and
+                                val > profiles[(row - 1) * BLOCK + m]):
+                            peaks[m].push_back(row)
+
+            for m in range(nblock):
+                if nactive == 0:
+                    break
+                col = cols[b + m]
+
+                # assign each peak to the nearest trace
+                for k in range(peaks[m].size()):
+                    owner[k] = -1
+                k = -1
+                hint = 0
+                for i in range(ntraces):
+                    if tolcounter[i] < 0:
+                        continue
+                    prediction = traces[i].predict(col)
+                    if not peaks[m].empty():
+                        k = nearest_peak(peaks[m], prediction, hint, &dis[i])
+                        hint = k
+                    if k >= 0 and dis[i] <= maxdis:
+                        nearest[i] = k
+                        if owner[k] < 0 or dis[i] < dis[owner[k]]:
+                            owner[k] = i
+                    else:
+                        nearest[i] = -1
+
+                for i in range(ntraces):
+                    if tolcounter[i] < 0:
+                        continue
+                    k = nearest[i]
+                    if k < 0 or owner[k] != <int>i:
+                        # peak is not found
+                        if tolcounter[i] > 0:
+                            tolcounter[i] -= 1
+                        else:
+                            # this trace is lost
+                            tolcounter[i] = -1
+                            nactive -= 1
+                        continue
+
+                    tolcounter[i] = tol
+                    row = peaks[m][k]
+                    result = interp_max_3(raw[(row - 1) * BLOCK + m],
+                                          raw[row * BLOCK + m],
+                                          raw[(row + 1) * BLOCK + m])
+                    traces[i].push_back(col, result.x + row, result.y)
+
+            b += nblock
+
+
+cdef _trace_points(vector[Trace]& traces):
+    '''Points and offsets of the traces.'''
+
+    cdef size_t ntraces = traces.size()
+    cdef size_t i, j, k
+
+    offsets = numpy.zeros((ntraces + 1,), dtype='intp')
+    for i in range(ntraces):
+        offsets[i + 1] = offsets[i] + traces[i].xtrace.size()
+
+    points = numpy.empty((offsets[ntraces], 3), dtype='float')
+    cdef double[:, :] points_v = points
+
+    k = 0
+    for i in range(ntraces):
+        for j in range(traces[i].xtrace.size()):
+            points_v[k, 0] = traces[i].xtrace[j]
+            points_v[k, 1] = traces[i].ytrace[j]
+            points_v[k, 2] = traces[i].ptrace[j]
+            k += 1
+
+    return points, offsets
 
-    return trace
 
 @cython.cdivision(True)
 @cython.boundscheck(False)
@@ -213,16 +454,12 @@ def tracing(FType[:, :] arr, double x, double y, double p, size_t step=1,
                      double maxdis=2.0):
     
     cdef Trace trace 
-    # Initial values    
-    trace.push_back(x, y, p)
+    cdef vector[double] pbuff
+    cdef vector[int] peaks
 
-    _internal_tracing(arr, trace, x, y, step=step, hs=hs, tol=tol,
-                      maxdis=maxdis, background=background,
-                      direction=-1)
-    trace.reverse()
-    _internal_tracing(arr, trace, x, y, step=step, hs=hs, tol=tol,
-                     maxdis=maxdis, background=background,
-                     direction=+1)
+    with nogil:
+        _tracing(arr, trace, x, y, p, pbuff, peaks, step=step, hs=hs, tol=tol,
+                 background=background, maxdis=maxdis)
 
     result = numpy.empty((trace.xtrace.size(), 3), dtype='float')
     
@@ -233,3 +470,83 @@ def tracing(FType[:, :] arr, double x, double y, double p, size_t step=1,
     
     return result
 
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+def tracing_many(FType[:, :] arr, double[:] x, double[:] y, double[:] p,
+                 size_t step=1, size_t hs=1, size_t tol=2,
+                 double background=150.0, double maxdis=2.0):
+    '''Trace several peaks, starting in (x, y, p).
+
+    The tracing runs without the GIL. Returns the points of all
+    the traces, with shape (npoints, 3), and the offsets of the traces:
+    the points of the trace i are in points[offsets[i]:offsets[i+1]].
+    '''
+
+    cdef size_t ntraces = x.shape[0]
+    cdef vector[Trace] traces
+    cdef vector[double] pbuff
+    cdef vector[int] peaks
+    cdef size_t i
+
+    if y.shape[0] != ntraces or p.shape[0] != ntraces:
+        raise ValueError('x, y and p must have the same size')
+
+    traces.resize(ntraces)
+
+    with nogil:
+        for i in range(ntraces):
+            _tracing(arr, traces[i], x[i], y[i], p[i], pbuff, peaks,
+                     step=step, hs=hs, tol=tol, background=background,
+                     maxdis=maxdis)
+
+    return _trace_points(traces)
+
+
+def tracing_global(FType[:, :] arr, double[:] x, double[:] y, double[:] p,
+                   size_t step=1, size_t hs=1, size_t tol=2,
+                   double background=150.0, double maxdis=2.0):
+    '''Trace several peaks together, starting in (x, y, p).
+
+    All the traces start in the same column. The traces advance together,
+    each column is collapsed once and its peaks are assigned to the
+    nearest predicted trace, each peak to one trace only. Peaks in the
+    first and last rows are not used. The result is as in tracing_many.
+    '''
+
+    cdef size_t ntraces = x.shape[0]
+    cdef vector[Trace] traces
+    cdef vector[double] profiles
+    cdef FType* raw
+    cdef size_t i
+
+    if y.shape[0] != ntraces or p.shape[0] != ntraces:
+        raise ValueError('x, y and p must have the same size')
+
+    if step == 0:
+        raise ValueError('step must be positive')
+
+    for i in range(1, ntraces):
+        if x[i] != x[0]:
+            raise ValueError('all the traces must start in the same column')
+
+    traces.resize(ntraces)
+    for i in range(ntraces):
+        traces[i].push_back(x[i], y[i], p[i])
+
+    if ntraces == 0 or arr.shape[0] < 3:
+        return _trace_points(traces)
+
+    profiles.resize(arr.shape[0] * BLOCK)
+    raw = <FType*>malloc(arr.shape[0] * BLOCK * sizeof(FType))
+    if raw == NULL:
+        raise MemoryError()
+
+    try:
+        with nogil:
+            _tracing_global(arr, traces, step, hs, tol, background, maxdis,
+                            &profiles[0], raw)
+    finally:
+        free(raw)
+
+    return _trace_points(traces)
@@ -2,27 +2,41 @@
 from setuptools import find_packages, setup
 from setuptools import setup, Extension
 
-# try to handle gracefully Cython
+from distutils.version import LooseVersion
+
+import numpy
+
+# The extensions are built with Cython, const memoryviews
+# need version 0.28
+CYTHON_MIN_VERSION = '0.28'
+
 try:
+    import Cython
     from Cython.Distutils import build_ext
-    ext1 = Extension('megaradrp.trace._traces',
-                     ['megaradrp/trace/traces.pyx',
-                      'megaradrp/trace/Trace.cpp'],
-                     language='c++')
-    ext2 = Extension('megaradrp.trace._extract',
-                     ['megaradrp/trace/extract.pyx'],
-                     language='c++')
-    cmdclass = {'build_ext': build_ext}
 except ImportError:
-    print('We do not have Cython, just using the generated files')
-    ext1 = Extension('megaradrp.trace._traces',
-                     ['megaradrp/trace/traces.cpp',
-                      'megaradrp/trace/Trace.cpp'],
-                     language='c++')
-    ext2 = Extension('megaradrp.trace._extract',
-                     ['megaradrp/trace/extract.cpp'],
-                     language='c++')
-    cmdclass = {}
+    raise SystemExit('Cython >= %s is required to build megaradrp' %
+                     CYTHON_MIN_VERSION)
+
+if LooseVersion(Cython.__version__) < LooseVersion(CYTHON_MIN_VERSION):
+    raise SystemExit('Cython >= %s is required to build megaradrp, '
+                     'found %s' % (CYTHON_MIN_VERSION, Cython.__version__))
+
+# The extensions cimport numpy
+NUMPY_INCLUDE = [numpy.get_include()]
+
+ext1 = Extension('megaradrp.trace._traces',
+                 ['megaradrp/trace/traces.pyx',
+                  'megaradrp/trace/Trace.cpp'],
+                 include_dirs=NUMPY_INCLUDE,
+                 language='c++')
+ext2 = Extension('megaradrp.trace._extract',
+                 ['megaradrp/trace/extract.pyx'],
+                 include_dirs=NUMPY_INCLUDE,
+                 language='c++')
+ext3 = Extension('megaradrp.trace._peakdetection',
+                 ['megaradrp/trace/peakdetection.pyx'],
+                 include_dirs=NUMPY_INCLUDE,
+                 language='c++')
 
 setup(name='megaradrp',
       version='0.5.dev',
@@ -33,6 +47,7 @@ setup(name='megaradrp',
       description='MEGARA Data Reduction Pipeline',
       packages=find_packages(),
       package_data={'megaradrp': ['drp.yaml', 'primary.txt']},
+      setup_requires=['numpy', 'cython >= %s' % CYTHON_MIN_VERSION],
       install_requires=[
          'numpy',
          'astropy >= 0.4, < 0.5',
@@ -40,8 +55,8 @@ setup(name='megaradrp',
          'numina >= 0.13.0',
          ],
       zip_safe=False,
-      ext_modules=[ext1, ext2],
-      cmdclass=cmdclass,
+      ext_modules=[ext1, ext2, ext3],
+      cmdclass={'build_ext': build_ext},
       entry_points = {
         'numina.pipeline.1': [
             'megara = megaradrp.loader:megara_drp_load',